@@ -6,7 +6,7 @@ import torch.nn as nn
 import numpy as np
 
 from rdkit import Chem
-from .utils import mol2graph, get_atom_fdim, get_bond_fdim
+from .utils import mol2graph, get_atom_fdim, get_bond_fdim, BatchMolGraph
 from chemprop.nn_utils import index_select_ND, get_activation_function
 import math
 import torch.nn.functional as F
@@ -14,6 +14,25 @@ from torch_scatter import scatter_add
 import pdb
 
 
+# index tensors of the functional prompt, cached by number of molecules and device
+FG_INDEX_CACHE = {}
+
+
+def fg_index(n_mols, device):
+    """
+    Returns the rows of f_fgs holding the CLS embedding of every molecule (each molecule has a block
+    of 13 rows) and the molecule of every row of f_fgs.
+
+    :param n_mols: The number of molecules in the batch.
+    :param device: The device of the index tensors.
+    """
+    key = (n_mols, str(device))
+    if key not in FG_INDEX_CACHE:
+        mol_index = torch.arange(n_mols, device=device)
+        FG_INDEX_CACHE[key] = (mol_index * 13, torch.repeat_interleave(mol_index, 13))
+    return FG_INDEX_CACHE[key]
+
+
 class CMPNEncoder(nn.Module):
     def __init__(self, args: Namespace, atom_fdim: int, bond_fdim: int):
         super(CMPNEncoder, self).__init__()
@@ -62,33 +81,35 @@ class CMPNEncoder(nn.Module):
         self.cls = nn.Parameter(torch.randn(1,133), requires_grad=True)
         self.W_i_atom_new = nn.Linear(self.atom_fdim*2, self.hidden_size, bias=self.bias)
 
-    def forward(self, step, mol_graph, features_batch=None, atom_output=False) -> torch.FloatTensor:
+    def forward(self, step, mol_graph, features_batch=None, atom_output=False, padded=False) -> torch.FloatTensor:
+        inputs = encoder_inputs(mol_graph, self.args, self.args.cuda or next(self.parameters()).is_cuda)
+        return self.encode(*inputs, padded=padded)
 
-        f_atoms, f_bonds, a2b, b2a, b2revb, a_scope, atom_num, fg_num, f_fgs, fg_scope = mol_graph.get_components()
-        if self.args.cuda or next(self.parameters()).is_cuda:
-            f_atoms, f_bonds, a2b, b2a, b2revb, f_fgs = (
-                    f_atoms.to(self.args.device), f_bonds.to(self.args.device), 
-                    a2b.to(self.args.device), b2a.to(self.args.device), b2revb.to(self.args.device), f_fgs.to(self.args.device))
-        
-        fg_index = [i*13 for i in range(mol_graph.n_mols)]
-        fg_indxs = [[i]*133 for i in fg_index]
-        fg_indxs = torch.LongTensor(fg_indxs).to(self.args.device)
+    def encode(self, f_atoms, f_bonds, a2b, b2a, b2revb, f_fgs, atom_num, cls_index, target_index, mol_count,
+               atom_index, mol_index, pos_index, atom_mask, padded: bool = True):
+        """
+        Encodes a batch of molecules given as the tensors of encoder_inputs.
 
+        All sizes follow from the shapes of the inputs, so that the encoder can be traced once and
+        run on batches of any size (see model/compiled.py).
+
+        :param padded: Whether to return the atoms as a padded tensor and a mask instead of a list.
+        """
         if self.args.step == 'functional_prompt':
             # make sure the prompt exists
             assert self.W_i_atom.prompt_generator
             # Input
             input_atom = self.W_i_atom(f_atoms)  # num_atoms x hidden_size
-            input_atom = self.W_i_atom.prompt_generator(input_atom, f_fgs, atom_num, fg_indxs)
+            # the functional prompts attend across the molecules of the batch, a molecule encoded once
+            # for several rows is weighted by its number of rows
+            input_atom = self.W_i_atom.prompt_generator(input_atom, f_fgs, atom_num, cls_index,
+                                                        mol_count[target_index])
         
         elif self.args.step == 'finetune_add':
-            for i in range(len(fg_indxs)):
-                f_fgs.scatter_(0, fg_indxs[i:i+1], self.cls)
+            f_fgs.index_copy_(0, cls_index, self.cls.expand(cls_index.size(0), -1))
             
-            target_index = [val for val in range(mol_graph.n_mols) for i in range(13)]
-            target_index = torch.LongTensor(target_index).to(self.args.device)
             fg_hiddens = scatter_add(f_fgs, target_index, 0)
-            fg_hiddens_atom = torch.repeat_interleave(fg_hiddens, torch.tensor(atom_num).to(self.args.device), dim=0)
+            fg_hiddens_atom = torch.repeat_interleave(fg_hiddens, atom_num, dim=0)
             fg_out = torch.zeros(1, 133).to(self.args.device)
             fg_out = torch.cat((fg_out, fg_hiddens_atom), 0)
             f_atoms += fg_out
@@ -96,13 +117,10 @@ class CMPNEncoder(nn.Module):
             input_atom = self.W_i_atom(f_atoms)  # num_atoms x hidden_size
         
         elif self.args.step == 'finetune_concat':
-            for i in range(len(fg_indxs)):
-                f_fgs.scatter_(0, fg_indxs[i:i+1], self.cls)
+            f_fgs.index_copy_(0, cls_index, self.cls.expand(cls_index.size(0), -1))
             
-            target_index = [val for val in range(mol_graph.n_mols) for i in range(13)]
-            target_index = torch.LongTensor(target_index).to(self.args.device)
             fg_hiddens = scatter_add(f_fgs, target_index, 0)
-            fg_hiddens_atom = torch.repeat_interleave(fg_hiddens, torch.tensor(atom_num).to(self.args.device), dim=0)
+            fg_hiddens_atom = torch.repeat_interleave(fg_hiddens, atom_num, dim=0)
             fg_out = torch.zeros(1, 133).to(self.args.device)
             fg_out = torch.cat((fg_out, fg_hiddens_atom), 0)
             f_atoms = torch.cat((fg_out, f_atoms), 1)
@@ -135,24 +153,74 @@ class CMPNEncoder(nn.Module):
         agg_message = index_select_ND(message_bond, a2b)
         agg_message = agg_message.sum(dim=1) * agg_message.max(dim=1)[0]
         agg_message = self.lr(torch.cat([agg_message, message_atom, input_atom], 1))
-        agg_message = self.gru(agg_message, a_scope)
+        agg_message = self.gru(agg_message, None, (atom_index, mol_index, pos_index, atom_mask))
         
         atom_hiddens = self.act_func(self.W_o(agg_message))  # num_atoms x hidden
         atom_hiddens = self.dropout_layer(atom_hiddens)  # num_atoms x hidden
         
         # Readout
-        mol_vecs = []
-        atom_vecs = []
-        for i, (a_start, a_size) in enumerate(a_scope):
-            if a_size == 0:
-                assert 0
-            cur_hiddens = atom_hiddens.narrow(0, a_start, a_size)
-            mol_vecs.append(cur_hiddens.mean(0))
-            
-            atom_vecs.append(cur_hiddens)
-                
-        mol_vecs = torch.stack(mol_vecs, dim=0)
-        return mol_vecs, atom_vecs
+        # the atoms padded to [num_molecules, max_atoms, hidden] and the mean of the atoms of every molecule
+        atom_vecs = atom_hiddens.new_zeros(atom_mask.size(0), atom_mask.size(1), self.hidden_size)
+        atom_vecs[mol_index, pos_index] = atom_hiddens[atom_index]
+        mol_vecs = atom_vecs.sum(1) / atom_num.unsqueeze(1)
+        if padded:
+            return mol_vecs, atom_vecs, atom_mask
+        return mol_vecs, list(atom_hiddens[atom_index].split(atom_num.tolist()))
+
+
+def encoder_inputs(mol_graph: BatchMolGraph, args: Namespace, to_device: bool = False) -> tuple:
+    """
+    Collects the tensors of a BatchMolGraph that CMPNEncoder.encode takes.
+
+    :param mol_graph: A BatchMolGraph.
+    :param args: Arguments.
+    :param to_device: Whether to move the tensors to args.device.
+    :return: f_atoms, f_bonds, a2b, b2a, b2revb, f_fgs, the number of atoms of every molecule,
+             the functional prompt indices (see fg_index), the number of rows of every molecule in the
+             batch it was deduplicated from (see unique_molecules) and the scope indices (see scope_index).
+    """
+    f_atoms, f_bonds, a2b, b2a, b2revb, a_scope, atom_num, fg_num, f_fgs, fg_scope = mol_graph.get_components()
+    if to_device:
+        a2b, b2a, b2revb, f_fgs = (
+                a2b.to(args.device), b2a.to(args.device), b2revb.to(args.device), f_fgs.to(args.device))
+        if not mol_graph.index_encoded:
+            f_atoms, f_bonds = f_atoms.to(args.device), f_bonds.to(args.device)
+    if mol_graph.index_encoded:
+        # only the hot feature columns were sent to the device
+        f_atoms, f_bonds = mol_graph.expand_features(b2a)
+    device = a2b.device
+    cls_index, target_index = fg_index(mol_graph.n_mols, device)
+    atom_num = torch.tensor(atom_num, device=device)
+    if mol_graph.row_index is None:
+        mol_count = torch.ones(mol_graph.n_mols, device=device)
+    else:
+        mol_count = torch.bincount(torch.as_tensor(mol_graph.row_index, device=device),
+                                   minlength=mol_graph.n_mols).float()
+    return (f_atoms, f_bonds, a2b, b2a, b2revb, f_fgs, atom_num, cls_index, target_index, mol_count) + \
+           scope_index(a_scope, device)
+
+
+def scope_index(a_scope, device):
+    """
+    Maps the atoms of a batch to their (molecule, position) in a padded [num_molecules, max_atoms] layout.
+
+    :param a_scope: A list of (start atom index, number of atoms) of every molecule.
+    :param device: The device of the returned index tensors.
+    :return: The atom index, molecule index and position of every atom in molecule order, and the
+             [num_molecules, max_atoms] mask of the padded layout.
+    """
+    a_start, a_size = zip(*a_scope)
+    if min(a_size) == 0:
+        assert 0
+    a_start = torch.tensor(a_start, device=device)
+    a_size = torch.tensor(a_size, device=device)
+    mol_index = torch.repeat_interleave(torch.arange(len(a_scope), device=device), a_size)
+    offset = torch.cumsum(a_size, 0) - a_size
+    pos_index = torch.arange(len(mol_index), device=device) - offset[mol_index]
+    atom_index = a_start[mol_index] + pos_index
+    atom_mask = torch.zeros(len(a_scope), int(a_size.max()), dtype=torch.bool, device=device)
+    atom_mask[mol_index, pos_index] = True
+    return atom_index, mol_index, pos_index, atom_mask
 
 
 class BatchGRU(nn.Module):
@@ -166,33 +234,27 @@ class BatchGRU(nn.Module):
                                 1.0 / math.sqrt(self.hidden_size))
 
 
-    def forward(self, node, a_scope):
+    def forward(self, node, a_scope, index=None):
         hidden = node
         message = F.relu(node + self.bias)
-        MAX_atom_len = max([a_size for a_start, a_size in a_scope])
+        if index is None:
+            index = scope_index(a_scope, node.device)
+        atom_index, mol_index, pos_index, atom_mask = index
+        num_mols, MAX_atom_len = atom_mask.size(0), atom_mask.size(1)
         # padding
-        message_lst = []
-        hidden_lst = []
-        for i, (a_start, a_size) in enumerate(a_scope):
-            if a_size == 0:
-                assert 0
-            cur_message = message.narrow(0, a_start, a_size)
-            cur_hidden = hidden.narrow(0, a_start, a_size)
-            hidden_lst.append(cur_hidden.max(0)[0].unsqueeze(0).unsqueeze(0))
-            
-            cur_message = torch.nn.ZeroPad2d((0,0,0,MAX_atom_len-cur_message.shape[0]))(cur_message)
-            message_lst.append(cur_message.unsqueeze(0))
-            
-        message_lst = torch.cat(message_lst, 0)
-        hidden_lst  = torch.cat(hidden_lst, 1)
+        message_lst = message.new_zeros(num_mols, MAX_atom_len, self.hidden_size)
+        message_lst[mol_index, pos_index] = message[atom_index]
+        hidden_lst = hidden.new_full((num_mols, MAX_atom_len, self.hidden_size), float('-inf'))
+        hidden_lst[mol_index, pos_index] = hidden[atom_index]
+        hidden_lst = hidden_lst.max(1)[0].unsqueeze(0)
         hidden_lst = hidden_lst.repeat(2,1,1)
-        cur_message, cur_hidden = self.gru(message_lst, hidden_lst)
+        # the recurrence runs in float32 under bfloat16 autocast (--precision bf16), which would otherwise
+        # mix the bfloat16 outputs of the linear layers with float32 inputs
+        with torch.autocast(device_type=node.device.type, enabled=False):
+            cur_message, cur_hidden = self.gru(message_lst.float(), hidden_lst.float())
         
         # unpadding
-        cur_message_unpadding = []
-        for i, (a_start, a_size) in enumerate(a_scope):
-            cur_message_unpadding.append(cur_message[i, :a_size].view(-1, 2*self.hidden_size))
-        cur_message_unpadding = torch.cat(cur_message_unpadding, 0)
+        cur_message_unpadding = cur_message[mol_index, pos_index]
         
         message = torch.cat([torch.cat([message.narrow(0, 0, 1), message.narrow(0, 0, 1)], 1), 
                              cur_message_unpadding], 0)
@@ -213,10 +275,12 @@ class CMPN(nn.Module):
         self.encoder = CMPNEncoder(self.args, self.atom_fdim, self.bond_fdim)
 
     def forward(self, step, prompt: bool, batch,
-                features_batch: List[np.ndarray] = None) -> torch.FloatTensor:
-        if not self.graph_input:  # if features only, batch won't even be used
+                features_batch: List[np.ndarray] = None, padded: bool = False) -> torch.FloatTensor:
+        # batches may already be featurized, e.g. by model.prefetch
+        if not self.graph_input and not isinstance(batch, BatchMolGraph):  # if features only, batch won't even be used
             batch = mol2graph(batch, self.args, prompt)
-        mol, atom = self.encoder.forward(step, batch, features_batch)
+        # with padded=True the atoms are returned as a padded tensor and a mask instead of a list
+        output = self.encoder.forward(step, batch, features_batch, padded=padded)
         if self.args.baseline_model == 'KANO':
-            return mol
-        return mol, atom
+            return output[0]
+        return output
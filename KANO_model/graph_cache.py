@@ -0,0 +1,162 @@
+import os
+import json
+import uuid
+import atexit
+import numpy as np
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entries once they add up to more than max_size.
+
+    By default every entry counts as 1, so max_size is a number of entries; with sizeof, entries
+    count as sizeof(value), e.g. their size in bytes. Hits, misses and evictions are counted so that
+    callers can report how well the cache works.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_size = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        size = 1 if self.sizeof is None else self.sizeof(value)
+        self.total_size += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while self.total_size > self.max_size and self._data:
+            old_key, _ = self._data.popitem(last=False)
+            self.total_size -= self._sizes.pop(old_key)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.total_size = 0
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'total_size': self.total_size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class GraphStore:
+    """
+    A persistent, content-addressed store of featurized molecular graphs.
+
+    Every graph is a dict of NumPy arrays (see MolGraph.to_arrays) saved under a content key.
+    New graphs are buffered in memory and written out in append-only shards. A shard is a
+    directory holding one .npy file per array name, with the rows of all of its graphs
+    concatenated, plus keys.json with the keys and the row offsets of every graph.
+    Shards are opened with mmap_mode='r', so a lookup only reads the rows of that graph.
+    """
+
+    def __init__(self, path: str, flush_size: int = 10000):
+        self.path = path
+        self.flush_size = flush_size
+        self._index = {}  # key -> (shard index, graph index in shard)
+        self._shards = []  # list of (shard directory, array names, offsets)
+        self._arrays = {}  # (shard index, array name) -> memory-mapped array
+        self._pending = {}  # key -> arrays not yet written to disk
+        os.makedirs(self.path, exist_ok=True)
+        for shard in sorted(os.listdir(self.path)):
+            if shard.startswith('shard-'):
+                self._open_shard(os.path.join(self.path, shard))
+        atexit.register(self.flush)
+
+    def _open_shard(self, shard_dir: str):
+        with open(os.path.join(shard_dir, 'keys.json'), 'r') as f:
+            meta = json.load(f)
+        offsets = np.load(os.path.join(shard_dir, 'offsets.npy'))
+        shard_idx = len(self._shards)
+        self._shards.append((shard_dir, meta['arrays'], offsets))
+        for i, key in enumerate(meta['keys']):
+            self._index.setdefault(key, (shard_idx, i))
+
+    def _load_array(self, shard_idx: int, name: str) -> np.ndarray:
+        if (shard_idx, name) not in self._arrays:
+            shard_dir = self._shards[shard_idx][0]
+            self._arrays[(shard_idx, name)] = np.load(os.path.join(shard_dir, f'{name}.npy'), mmap_mode='r')
+        return self._arrays[(shard_idx, name)]
+
+    def get(self, key: str):
+        """
+        Returns the arrays stored under key, or None if the graph has not been stored yet.
+
+        :param key: The content key of the graph.
+        :return: A dict mapping array names to (memory-mapped) NumPy arrays.
+        """
+        if key in self._pending:
+            return self._pending[key]
+        if key not in self._index:
+            return None
+        shard_idx, i = self._index[key]
+        _, names, offsets = self._shards[shard_idx]
+        return {name: self._load_array(shard_idx, name)[offsets[i, j]: offsets[i + 1, j]]
+                for j, name in enumerate(names)}
+
+    def put(self, key: str, arrays: dict):
+        if key in self._index or key in self._pending:
+            return
+        self._pending[key] = arrays
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered graphs to new shards, one per array layout."""
+        if not self._pending:
+            return
+        # graphs with different array names or dtypes (e.g. with and without prompt) cannot share a shard
+        layouts = {}
+        for key, arrays in self._pending.items():
+            layout = tuple(sorted((name, arrays[name].dtype.str) for name in arrays))
+            layouts.setdefault(layout, []).append(key)
+        for keys in layouts.values():
+            self._write_shard(keys)
+        self._pending = {}
+
+    def _write_shard(self, keys: list):
+        names = sorted(self._pending[keys[0]].keys())
+        lengths = np.array([[len(self._pending[key][name]) for name in names] for key in keys])
+        offsets = np.zeros((len(keys) + 1, len(names)), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths, axis=0)
+
+        # write to a temporary directory first so that readers never see half-written shards
+        shard_name = f'shard-{uuid.uuid4().hex}'
+        tmp_dir = os.path.join(self.path, f'.tmp-{shard_name}')
+        os.makedirs(tmp_dir)
+        for name in names:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'),
+                    np.concatenate([self._pending[key][name] for key in keys], axis=0))
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        with open(os.path.join(tmp_dir, 'keys.json'), 'w') as f:
+            json.dump({'keys': keys, 'arrays': names}, f)
+        os.rename(tmp_dir, os.path.join(self.path, shard_name))
+
+        self._open_shard(os.path.join(self.path, shard_name))
+
+    def __contains__(self, key):
+        return key in self._index or key in self._pending
+
+    def __len__(self):
+        return len(self._index) + len(self._pending)
@@ -154,10 +154,16 @@ def build_pretrain_model(args: Namespace, encoder_name) -> nn.Module:
 
     return model
 
-def attention(query, key, value, mask, dropout=None):
-    """Compute 'Scaled Dot Product Attention'"""
+def attention(query, key, value, mask, dropout=None, key_count=None):
+    """Compute 'Scaled Dot Product Attention'
+
+    :param key_count: How many identical keys every key stands for, e.g. the rows of a molecule in a batch
+                      deduplicated by unique_molecules, so that the keys are weighted as in the full batch.
+    """
     d_k = query.size(-1)
     scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(d_k)
+    if key_count is not None:
+        scores = scores + torch.log(key_count)
     if mask is not None:
         scores = scores.masked_fill(mask == 0, -1e9)
     
@@ -178,14 +184,14 @@ class AttentionLayer(nn.Module):
         self.LayerNorm = nn.LayerNorm(133, eps=1e-6)
         self.dropout = nn.Dropout(0.1)
         
-    def forward(self,fg_hiddens, init_hiddens):
+    def forward(self,fg_hiddens, init_hiddens, fg_count=None):
         query = self.w_q(fg_hiddens)
         key = self.w_k(fg_hiddens)
         value = self.w_v(fg_hiddens)
 
         padding_mask = (init_hiddens != 0) + 0.0
         mask = torch.matmul(padding_mask, padding_mask.transpose(-2, -1))
-        x, attn = attention(query, key, value, mask)
+        x, attn = attention(query, key, value, mask, key_count=fg_count)
 
         hidden_states = self.dense(x)
         hidden_states = self.dropout(hidden_states)
@@ -205,16 +211,17 @@ class Prompt_generator(nn.Module):
         self.attention_layer_2 = AttentionLayer(args)
         self.norm = nn.LayerNorm(args.hidden_size)
         
-    def forward(self, atom_hiddens: torch.Tensor, fg_states: torch.Tensor, atom_num, fg_indexs):
-        for i in range(len(fg_indexs)):
-            fg_states.scatter_(0, fg_indexs[i:i+1], self.cls)
+    def forward(self, atom_hiddens: torch.Tensor, fg_states: torch.Tensor, atom_num, fg_indexs, fg_count=None):
+        # fg_indexs holds the CLS row of every molecule in fg_states,
+        # fg_count the number of rows of the batch of the molecule of every row of fg_states
+        fg_states.index_copy_(0, fg_indexs, self.cls.expand(fg_indexs.size(0), -1))
         
-        hidden_states = self.attention_layer_1(fg_states, fg_states)
-        hidden_states = self.attention_layer_2(hidden_states, fg_states)
+        hidden_states = self.attention_layer_1(fg_states, fg_states, fg_count)
+        hidden_states = self.attention_layer_2(hidden_states, fg_states, fg_count)
         fg_out = torch.zeros(1, self.hidden_size).to(atom_hiddens.device)
-        cls_hiddens = torch.gather(hidden_states, 0, fg_indexs)
+        cls_hiddens = hidden_states.index_select(0, fg_indexs)
         cls_hiddens = self.linear(cls_hiddens)
-        fg_hiddens = torch.repeat_interleave(cls_hiddens, torch.tensor(atom_num).to(atom_hiddens.device), dim=0)
+        fg_hiddens = torch.repeat_interleave(cls_hiddens, torch.as_tensor(atom_num, device=atom_hiddens.device), dim=0)
         fg_out = torch.cat((fg_out, fg_hiddens), 0)
 
         fg_out = self.norm(fg_out)
@@ -1,4 +1,5 @@
 import pickle
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
@@ -9,6 +10,7 @@ from chemprop.nn_utils import NoamLR
 from argparse import Namespace
 from typing import List, Union, Tuple
 from chemprop.features.featurization import atom_features, bond_features
+from .graph_cache import LRUCache, GraphStore
 
 # Atom feature sizes
 MAX_ATOMIC_NUM = 100
@@ -38,7 +40,10 @@ ATOM_FDIM = sum(len(choices) + 1 for choices in ATOM_FEATURES.values()) + 2
 BOND_FDIM = 14
 
 # Memoization
-SMILES_TO_GRAPH = {}
+SMILES_TO_GRAPH = None  # in-memory LRU of MolGraphs, created on first use
+GRAPH_STORE = None  # persistent on-disk store of featurized graphs
+# bump when the featurization or the keys change so that stale graphs on disk are never reused
+GRAPH_VERSION = 3
 
 eletype_list = [i for i in range(118)]
 
@@ -51,12 +56,50 @@ with open('./KANO_model/initial/funcgroup.txt', "r") as f:
     name = [i.split()[0] for i in funcgroups]
     smart = [Chem.MolFromSmarts(i.split()[1]) for i in funcgroups]
     smart2name = dict(zip(smart, name))
-    
+
+
+def element_counts(mol, required: bool = False):
+    """
+    Counts the atoms of each element in a molecule.
+
+    :param mol: A molecule or SMARTS pattern.
+    :param required: For patterns, only count the query atoms that pin down a single element.
+    :return: A numpy array of counts indexed by atomic number.
+    """
+    counts = np.bincount([atom.GetAtomicNum() for atom in mol.GetAtoms()], minlength=119)
+    if required:
+        counts[0] = 0  # wildcards, element lists and recursive SMARTS
+    return counts
+
+# a molecule can only match a pattern if it has at least as many atoms of every element the pattern requires
+smart_elements = np.stack([element_counts(sm, required=True) for sm in smart])
+FG_CACHE = LRUCache(100000)  # canonical smiles -> f_fgs block
+CANONICAL_SMILES = LRUCache(100000)  # smiles -> canonical smiles
+
 hrc2emb = {}
 for eletype in eletype_list:
     hrc_emb = np.random.rand(14)
     hrc2emb[eletype] = hrc_emb
 
+# elements with a relation in the knowledge graph, e1 -> {e2 > e1}
+rel_neighbors = {}
+for e1, e2 in rel2emb.keys():
+    if e1 < e2:
+        rel_neighbors.setdefault(e1, set()).add(e2)
+
+def sorted_bonds(mol):
+    """
+    Lists the bonds of a molecule as (a1, a2, bond) with a1 < a2, in increasing (a1, a2) order.
+
+    This is the order in which MolGraph used to visit all atom pairs, in O(n_bonds log n_bonds).
+    """
+    bonds = []
+    for bond in mol.GetBonds():
+        a1, a2 = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        bonds.append((min(a1, a2), max(a1, a2), bond))
+    bonds.sort(key=lambda x: (x[0], x[1]))
+    return bonds
+
 def hrc_features(ele):
     fhrc = hrc2emb[ele]
     return fhrc.tolist()
@@ -69,16 +112,45 @@ def relation_features(e1,e2):
     frel = rel2emb[(e1,e2)]
     return frel.tolist()
 
-def match_fg(mol):
-    fg_emb = [[1] * 133]
-    pad_fg = [[0] * 133]
-    for sm in smart:
-        if mol.HasSubstructMatch(sm):
-            fg_emb.append(fg2emb[smart2name[sm]].tolist())
-    if len(fg_emb) > 13:
-        fg_emb = fg_emb[:13]
-    else:
-        fg_emb.extend(pad_fg * (13 - len(fg_emb)))
+def canonical_smiles(smiles: str, mol=None) -> str:
+    """
+    Returns the canonical form of a smiles string, memoized since it is needed by several caches.
+
+    :param smiles: A smiles string.
+    :param mol: The molecule of smiles, if it has already been parsed.
+    """
+    canonical = CANONICAL_SMILES.get(smiles)
+    if canonical is None:
+        canonical = Chem.MolToSmiles(mol if mol is not None else Chem.MolFromSmiles(smiles))
+        CANONICAL_SMILES.put(smiles, canonical)
+    return canonical
+
+def match_fg(mol, smiles: str):
+    """
+    Embeds the functional groups of a molecule as a [13, 133] block: a row of ones followed by the
+    embeddings of the first 12 matching patterns of funcgroup.txt, padded with zeros.
+
+    Patterns are pre-screened by the elements they require so that only candidates are matched
+    with HasSubstructMatch, and the block is memoized per canonical smiles. The returned array
+    is shared between molecules and must not be modified.
+
+    :param mol: The molecule.
+    :param smiles: The smiles string of mol.
+    """
+    canonical = canonical_smiles(smiles, mol)
+    fg_emb = FG_CACHE.get(canonical)
+    if fg_emb is None:
+        fg_emb = np.zeros((13, 133), dtype=np.float32)
+        fg_emb[0] = 1
+        n_fgs = 1
+        for i in np.flatnonzero((smart_elements <= element_counts(mol)).all(axis=1)):
+            if mol.HasSubstructMatch(smart[i]):
+                fg_emb[n_fgs] = fg2emb[smart2name[smart[i]]]
+                n_fgs += 1
+                if n_fgs == 13:
+                    break
+        fg_emb.flags.writeable = False
+        FG_CACHE.put(canonical, fg_emb)
     return fg_emb
 
 def get_atom_fdim(args: Namespace) -> int:
@@ -147,16 +219,26 @@ class MolGraph:
     """
     A MolGraph represents the graph structure and featurization of a single molecule.
 
-    A MolGraph computes the following attributes:
+    The featurization is kept in compact NumPy arrays, so that large caches of MolGraphs fit in memory:
     - smiles: Smiles string.
-    - n_atoms: The number of atoms in the molecule.
-    - n_bonds: The number of bonds in the molecule.
-    - f_atoms: A mapping from an atom index to a list atom features.
-    - f_bonds: A mapping from a bond index to a list of bond features.
-    - a2b: A mapping from an atom index to a list of incoming bond indices.
+    - prompt: Whether the graph has element nodes (prompt mode).
+    - n_atoms: The number of atoms in the molecule, including the element nodes in prompt mode.
+    - n_bonds: The number of (directed) bonds in the molecule.
+    - n_fgs: The number of functional group rows.
+    - f_atoms: The atom features. uint8 one-hot features without the last (mass) feature, or
+      float32 rows of all atom features in prompt mode since element nodes are embeddings.
+    - atom_mass: The float32 mass feature of every atom (None in prompt mode).
+    - f_bonds: The bond features of every bond, shared by its two directions (uint8, or float32
+      in prompt mode). BatchMolGraph prepends the features of the atom a bond originates from.
+    - f_fgs: The functional group features.
     - b2a: A mapping from a bond index to the index of the atom the bond originates from.
     - b2revb: A mapping from a bond index to the index of the reverse bond.
+
+    Bonds 2i and 2i + 1 are the two directions of the i-th bond, so the mapping from atoms to
+    incoming bonds (a2b) follows from b2a and b2revb and is only built by BatchMolGraph.
     """
+    __slots__ = ('smiles', 'prompt', 'n_atoms', 'n_bonds', 'n_fgs', 'f_atoms', 'atom_mass',
+                 'f_bonds', 'f_fgs', 'b2a', 'b2revb')
 
     def __init__(self, smiles: str, args: Namespace, prompt: bool):
         """
@@ -166,134 +248,97 @@ class MolGraph:
         :param args: Arguments.
         """
         self.smiles = smiles
-        self.n_atoms = 0  # number of atoms
-        self.n_bonds = 0  # number of bonds
-        self.f_atoms = []  # mapping from atom index to atom features
-        self.f_bonds = []  # mapping from bond index to concat(in_atom, bond) features
-        
-        self.n_real_atoms = 0
-        self.n_eles = 0
-
-        self.a2b = []  # mapping from atom index to incoming bond indices
-        self.b2a = []  # mapping from bond index to the index of the atom the bond is coming from
-        self.b2revb = []  # mapping from bond index to the index of the reverse bond
-        self.bonds = []
+        self.prompt = prompt
         # Convert smiles to molecule
         mol = Chem.MolFromSmiles(smiles)
-        self.f_fgs = match_fg(mol)
+        self.f_fgs = match_fg(mol, smiles)
         self.n_fgs = len(self.f_fgs)
-        self.prompt = prompt
-
 
+        # Get atom features
+        f_atoms = [atom_features(atom) for atom in mol.GetAtoms()]
+        pairs = []  # (a1, a2) of every bond, in increasing order
+        f_bonds = []
         if not self.prompt:
-            # fake the number of "atoms" if we are collapsing substructures
-            self.n_atoms = mol.GetNumAtoms()
-            # Get atom features
-            for i, atom in enumerate(mol.GetAtoms()):
-                self.f_atoms.append(atom_features(atom))
-            self.f_atoms = [self.f_atoms[i] for i in range(self.n_atoms)]
-            for _ in range(self.n_atoms):
-                self.a2b.append([])
-
-            # Get bond features
-            for a1 in range(self.n_atoms):
-                for a2 in range(a1 + 1, self.n_atoms):
-                    bond = mol.GetBondBetweenAtoms(a1, a2)
-
-                    if bond is None:
-                        continue
-
-                    f_bond = bond_features(bond)
-
-                    if args.atom_messages:
-                        self.f_bonds.append(f_bond)
-                        self.f_bonds.append(f_bond)
-                    else:
-                        self.f_bonds.append(self.f_atoms[a1] + f_bond)
-                        self.f_bonds.append(self.f_atoms[a2] + f_bond)
-
-                    # Update index mappings
-                    b1 = self.n_bonds
-                    b2 = b1 + 1
-                    self.a2b[a2].append(b1)  # b1 = a1 --> a2
-                    self.b2a.append(a1)
-                    self.a2b[a1].append(b2)  # b2 = a2 --> a1
-                    self.b2a.append(a2)
-                    self.b2revb.append(b2)
-                    self.b2revb.append(b1)
-                    self.n_bonds += 2
-                    self.bonds.append(np.array([a1, a2]))
-                    
+            # Get bond features, in increasing (a1, a2) order
+            for a1, a2, bond in sorted_bonds(mol):
+                pairs.append((a1, a2))
+                f_bonds.append(bond_features(bond))
+
+            f_atoms = np.array(f_atoms, dtype=np.float32).reshape(-1, ATOM_FDIM)
+            self.f_atoms = f_atoms[:, :-1].astype(np.uint8)
+            self.atom_mass = f_atoms[:, -1].copy()
+            self.f_bonds = np.array(f_bonds, dtype=np.uint8).reshape(-1, BOND_FDIM)
         else:
-            # fake the number of "atoms" if we are collapsing substructures
-            self.n_real_atoms = mol.GetNumAtoms()
-            # Get atom features
-            self.atomic_nums = []
-            for i, atom in enumerate(mol.GetAtoms()):
-                self.f_atoms.append(atom_features(atom))
-                
-                atomicnum = atom.GetAtomicNum()
-                self.atomic_nums.append(atomicnum)
-            
-            self.eles = list(set(self.atomic_nums))
-            self.eles.sort()
-            self.n_eles = len(self.eles)
-            self.n_atoms += len(self.eles)+self.n_real_atoms
-            
-            self.f_eles = [ele_features(self.eles[i]) for i in range(self.n_eles)]
-            self.f_atoms += self.f_eles
-                        
-            self.f_atoms = [self.f_atoms[i] for i in range(self.n_atoms)]
-            
-            self.atomic_nums += self.eles
-
-            for _ in range(self.n_atoms):
-                self.a2b.append([])
-
-            # Get bond features
-            for a1 in range(self.n_atoms):
-                for a2 in range(a1 + 1, self.n_atoms):
-                    if a2 < self.n_real_atoms:
-                        bond = mol.GetBondBetweenAtoms(a1, a2)
-
-                        if bond is None:
-                            continue
-
-                        # f_bond = self.f_atoms[a1] + bond_features(bond)
-                        f_bond = bond_features(bond)
-                        
-                    
-                    elif a1 < self.n_real_atoms and a2 >= self.n_real_atoms:
-                        if self.atomic_nums[a1] == self.atomic_nums[a2]:
-                            ele = self.atomic_nums[a1]
-                            f_bond = hrc_features(ele)
-                        else:
-                            continue
-                            
-                    elif a1 >= self.n_real_atoms:
-                        if (self.atomic_nums[a1],self.atomic_nums[a2]) in rel2emb.keys():
-                            f_bond = relation_features(self.atomic_nums[a1], self.atomic_nums[a2])
-                        else:
-                            continue      
-
-                    if args.atom_messages:
-                        self.f_bonds.append(f_bond)
-                        self.f_bonds.append(f_bond)
-                    else:
-                        self.f_bonds.append(self.f_atoms[a1] + f_bond)
-                        self.f_bonds.append(self.f_atoms[a2] + f_bond)
-                        
-                    # Update index mappings
-                    b1 = self.n_bonds
-                    b2 = b1 + 1
-                    self.a2b[a2].append(b1)  # b1 = a1 --> a2
-                    self.b2a.append(a1)
-                    self.a2b[a1].append(b2)  # b2 = a2 --> a1
-                    self.b2a.append(a2)
-                    self.b2revb.append(b2)
-                    self.b2revb.append(b1)
-                    self.n_bonds += 2
-                    self.bonds.append(np.array([a1, a2]))
+            n_real_atoms = len(f_atoms)
+            atomic_nums = [atom.GetAtomicNum() for atom in mol.GetAtoms()]
+            eles = sorted(set(atomic_nums))
+            # one element node per element, after the real atoms
+            f_atoms += [ele_features(ele) for ele in eles]
+            ele_index = {ele: n_real_atoms + i for i, ele in enumerate(eles)}
+
+            # Get bond features, in increasing (a1, a2) order: the bonds of every real atom
+            # to higher real atoms and to its element node, then the relations between elements
+            neighbors = [[] for _ in range(n_real_atoms)]
+            for a1, a2, bond in sorted_bonds(mol):
+                neighbors[a1].append((a2, bond))
+            for a1 in range(n_real_atoms):
+                for a2, bond in neighbors[a1]:
+                    pairs.append((a1, a2))
+                    f_bonds.append(bond_features(bond))
+                ele = atomic_nums[a1]
+                pairs.append((a1, ele_index[ele]))
+                f_bonds.append(hrc_features(ele))
+            for i, e1 in enumerate(eles):
+                for e2 in eles[i + 1:]:
+                    if e2 in rel_neighbors.get(e1, ()):
+                        pairs.append((ele_index[e1], ele_index[e2]))
+                        f_bonds.append(relation_features(e1, e2))
+
+            self.f_atoms = np.array(f_atoms, dtype=np.float32).reshape(-1, ATOM_FDIM)
+            self.atom_mass = None
+            self.f_bonds = np.array(f_bonds, dtype=np.float32).reshape(-1, BOND_FDIM)
+
+        self.n_atoms = len(self.f_atoms)
+        # bond 2i = a1 --> a2 and bond 2i + 1 = a2 --> a1
+        self.b2a = np.array(pairs, dtype=np.int32).reshape(-1)
+        self.b2revb = np.arange(len(self.b2a), dtype=np.int32) ^ 1
+        self.n_bonds = len(self.b2a)
+
+    def to_arrays(self) -> dict:
+        """
+        Returns the arrays of the featurization, as stored in the GraphStore and collated by BatchMolGraph.
+
+        :return: A dict mapping array names to NumPy arrays.
+        """
+        arrays = {'f_atoms': self.f_atoms, 'f_bonds': self.f_bonds, 'f_fgs': self.f_fgs,
+                  'b2a': self.b2a, 'b2revb': self.b2revb}
+        if self.atom_mass is not None:
+            arrays['atom_mass'] = self.atom_mass
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, smiles: str, prompt: bool, arrays: dict) -> 'MolGraph':
+        """
+        Rebuilds a MolGraph from the arrays returned by to_arrays without touching RDKit.
+
+        :param smiles: A smiles string.
+        :param prompt: Whether the graph was featurized in prompt mode.
+        :param arrays: A dict of arrays as returned by to_arrays.
+        :return: The MolGraph.
+        """
+        mol_graph = cls.__new__(cls)
+        mol_graph.smiles = smiles
+        mol_graph.prompt = prompt
+        mol_graph.f_atoms = arrays['f_atoms']
+        mol_graph.atom_mass = arrays.get('atom_mass')
+        mol_graph.f_bonds = arrays['f_bonds']
+        mol_graph.f_fgs = arrays['f_fgs']
+        mol_graph.b2a = arrays['b2a']
+        mol_graph.b2revb = arrays['b2revb']
+        mol_graph.n_atoms = len(mol_graph.f_atoms)
+        mol_graph.n_bonds = len(mol_graph.b2a)
+        mol_graph.n_fgs = len(mol_graph.f_fgs)
+        return mol_graph
 
 
 class BatchMolGraph:
@@ -310,6 +355,12 @@ class BatchMolGraph:
     - max_num_bonds: The maximum number of bonds neighboring an atom in this batch.
     - b2b: (Optional) A mapping from a bond index to incoming bond indices.
     - a2a: (Optional): A mapping from an atom index to neighboring atom indices.
+    - row_index: (Optional) For a batch of distinct molecules, the molecule of every row of the
+      original batch (see unique_molecules).
+
+    With args.feature_encoding == 'index' (and without prompt), f_atoms and f_bonds are None.
+    Instead, the batch holds the indices of the hot columns (atom_index, bond_index) and the
+    masses (atom_mass), and expand_features rebuilds the dense features on the model's device.
     """
 
     def __init__(self, mol_graphs, args: Namespace):
@@ -318,59 +369,82 @@ class BatchMolGraph:
 
         self.atom_fdim = get_atom_fdim(args)
         self.bond_fdim = get_bond_fdim(args) + (not args.atom_messages) * self.atom_fdim # * 2
-        # Start n_atoms and n_bonds at 1 b/c zero padding
-        self.n_atoms = 1  # number of atoms (start at 1 b/c need index 0 as padding)
-        self.n_bonds = 1  # number of bonds (start at 1 b/c need index 0 as padding)
-        self.n_fgs = 1
-        self.atom_num = []
-        self.fg_num = []
-        self.a_scope = []  # list of tuples indicating (start_atom_index, num_atoms) for each molecule
-        self.b_scope = []  # list of tuples indicating (start_bond_index, num_bonds) for each molecule
-        self.fg_scope = []
-
-        # All start with zero padding so that indexing with zero padding returns zeros
-        f_atoms = [[0] * self.atom_fdim]  # atom features
-        f_bonds = [[0] * self.bond_fdim]  # combined atom/bond features
-        f_fgs = [] # fg features
-        a2b = [[]]  # mapping from atom index to incoming bond indices
-        b2a = [0]  # mapping from bond index to the index of the atom the bond is coming from
-        b2revb = [0]  # mapping from bond index to the index of the reverse bond
-        bonds = [[0,0]]
-        for mol_graph in mol_graphs:
-            f_atoms.extend(mol_graph.f_atoms)
-            f_bonds.extend(mol_graph.f_bonds)
-            f_fgs.extend(mol_graph.f_fgs)
-
-            for a in range(mol_graph.n_atoms):
-                a2b.append([b + self.n_bonds for b in mol_graph.a2b[a]]) #  if b!=-1 else 0
-
-            for b in range(mol_graph.n_bonds):
-                b2a.append(self.n_atoms + mol_graph.b2a[b])
-                b2revb.append(self.n_bonds + mol_graph.b2revb[b])
-                bonds.append([b2a[-1], 
-                              self.n_atoms + mol_graph.b2a[mol_graph.b2revb[b]]])
-            self.a_scope.append((self.n_atoms, mol_graph.n_atoms))
-            self.b_scope.append((self.n_bonds, mol_graph.n_bonds))
-            self.fg_scope.append((self.n_fgs, mol_graph.n_fgs))
-            self.atom_num.append(mol_graph.n_atoms)
-            self.fg_num.append(mol_graph.n_fgs)
-            self.n_atoms += mol_graph.n_atoms
-            self.n_bonds += mol_graph.n_bonds
-            self.n_fgs += mol_graph.n_fgs
-        
-        bonds = np.array(bonds).transpose(1,0)
-        
-        self.max_num_bonds = max(1, max(len(in_bonds) for in_bonds in a2b)) # max with 1 to fix a crash in rare case of all single-heavy-atom mols
-        
-        self.f_atoms = torch.FloatTensor(f_atoms)
-        self.f_bonds = torch.FloatTensor(f_bonds)
-        self.f_fgs = torch.FloatTensor(f_fgs)
-        self.a2b = torch.LongTensor([a2b[a][:self.max_num_bonds] + [0] * (self.max_num_bonds - len(a2b[a])) for a in range(self.n_atoms)])
-        self.b2a = torch.LongTensor(b2a)
-        self.bonds = torch.LongTensor(bonds)
-        self.b2revb = torch.LongTensor(b2revb)
+        arrays = [mol_graph.to_arrays() for mol_graph in mol_graphs]
+
+        atom_num = np.array([len(graph['f_atoms']) for graph in arrays], dtype=np.int64)
+        bond_num = np.array([len(graph['b2a']) for graph in arrays], dtype=np.int64)
+        fg_num = np.array([len(graph['f_fgs']) for graph in arrays], dtype=np.int64)
+        # Start at 1 b/c index 0 is zero padding, so that indexing with zero padding returns zeros
+        atom_start = 1 + np.cumsum(atom_num) - atom_num
+        bond_start = 1 + np.cumsum(bond_num) - bond_num
+        fg_start = 1 + np.cumsum(fg_num) - fg_num
+        self.n_atoms = 1 + int(atom_num.sum())  # number of atoms
+        self.n_bonds = 1 + int(bond_num.sum())  # number of bonds
+        self.n_fgs = 1 + int(fg_num.sum())
+        self.atom_num = atom_num.tolist()
+        self.fg_num = fg_num.tolist()
+        self.a_scope = list(zip(atom_start.tolist(), self.atom_num))  # (start_atom_index, num_atoms) for each molecule
+        self.b_scope = list(zip(bond_start.tolist(), bond_num.tolist()))  # (start_bond_index, num_bonds) for each molecule
+        self.fg_scope = list(zip(fg_start.tolist(), self.fg_num))
+
+        f_fgs = np.concatenate([graph['f_fgs'] for graph in arrays], axis=0)  # fg features
+
+        # shift the per-molecule indices by the offset of their molecule
+        b2a = np.zeros(self.n_bonds, dtype=np.int64)  # mapping from bond index to the index of the atom the bond is coming from
+        b2a[1:] = np.concatenate([graph['b2a'] for graph in arrays]) + np.repeat(atom_start, bond_num)
+        b2revb = np.zeros(self.n_bonds, dtype=np.int64)  # mapping from bond index to the index of the reverse bond
+        b2revb[1:] = np.concatenate([graph['b2revb'] for graph in arrays]) + np.repeat(bond_start, bond_num)
+        bonds = np.stack([b2a, b2a[b2revb]])
+
+        self.atom_messages = args.atom_messages
+        # one-hot features and masses are stored apart, except for prompt-mode graphs
+        self.index_encoded = args.feature_encoding == 'index' and 'atom_mass' in arrays[0]
+        if self.index_encoded:
+            self.atom_index = torch.from_numpy(hot_indices(np.concatenate(
+                [np.zeros((1, self.atom_fdim - 1), dtype=np.uint8)] + [graph['f_atoms'] for graph in arrays])))
+            self.atom_mass = torch.from_numpy(np.concatenate(
+                [np.zeros(1, dtype=np.float32)] + [graph['atom_mass'] for graph in arrays]))
+            # one row per bond, shared by both of its directions
+            self.bond_index = torch.from_numpy(hot_indices(np.concatenate([graph['f_bonds'] for graph in arrays])))
+            f_atoms = f_bonds = None
+        else:
+            f_atoms = np.zeros((self.n_atoms, self.atom_fdim), dtype=np.float32)  # atom features
+            if 'atom_mass' in arrays[0]:
+                f_atoms[1:, :-1] = np.concatenate([graph['f_atoms'] for graph in arrays], axis=0)
+                f_atoms[1:, -1] = np.concatenate([graph['atom_mass'] for graph in arrays])
+            else:
+                f_atoms[1:] = np.concatenate([graph['f_atoms'] for graph in arrays], axis=0)
+
+            # both directions of a bond share its bond features
+            f_bond_only = np.repeat(np.concatenate([graph['f_bonds'] for graph in arrays], axis=0), 2, axis=0)
+            f_bonds = np.zeros((self.n_bonds, self.bond_fdim), dtype=np.float32)  # combined atom/bond features
+            if args.atom_messages:
+                f_bonds[1:] = f_bond_only
+            else:
+                f_bonds[1:, :self.atom_fdim] = f_atoms[b2a[1:]]
+                f_bonds[1:, self.atom_fdim:] = f_bond_only
+            f_atoms, f_bonds = torch.from_numpy(f_atoms), torch.from_numpy(f_bonds)
+
+        # a2b lists the incoming bonds of every atom in increasing bond order, padded with 0
+        b2dst = b2a[b2revb][1:]
+        in_bonds = np.bincount(b2dst, minlength=self.n_atoms)
+        self.max_num_bonds = max(1, int(in_bonds.max())) # max with 1 to fix a crash in rare case of all single-heavy-atom mols
+        order = np.argsort(b2dst, kind='stable')
+        sorted_dst = b2dst[order]
+        position = np.arange(len(order)) - (np.cumsum(in_bonds) - in_bonds)[sorted_dst]
+        a2b = np.zeros((self.n_atoms, self.max_num_bonds), dtype=np.int64)  # mapping from atom index to incoming bond indices
+        a2b[sorted_dst, position] = order + 1
+
+        self.f_atoms = f_atoms
+        self.f_bonds = f_bonds
+        self.f_fgs = torch.from_numpy(f_fgs.astype(np.float32, copy=False))
+        self.a2b = torch.from_numpy(a2b)
+        self.b2a = torch.from_numpy(b2a)
+        self.bonds = torch.from_numpy(bonds)
+        self.b2revb = torch.from_numpy(b2revb)
         self.b2b = None  # try to avoid computing b2b b/c O(n_atoms^3)
         self.a2a = None  # only needed if using atom messages
+        self.row_index = None
 
     def get_components(self) -> Tuple[torch.FloatTensor, torch.FloatTensor,
                                       torch.LongTensor, torch.LongTensor, torch.LongTensor,
@@ -383,6 +457,22 @@ class BatchMolGraph:
         """
         return self.f_atoms, self.f_bonds, self.a2b, self.b2a, self.b2revb, self.a_scope, self.atom_num, self.fg_num, self.f_fgs, self.fg_scope
 
+    def expand_features(self, b2a: torch.LongTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        Rebuilds the dense atom and bond features of an index-encoded batch on the device of b2a.
+
+        :param b2a: The mapping from bond index to source atom index, on the target device.
+        :return: The atom features and the combined atom/bond features, as get_components would return them.
+        """
+        device = b2a.device
+        f_atoms = torch.cat([scatter_hot(self.atom_index.to(device), self.atom_fdim - 1),
+                             self.atom_mass.to(device).unsqueeze(1)], dim=1)
+        f_bond_only = scatter_hot(self.bond_index.to(device), BOND_FDIM).repeat_interleave(2, dim=0)
+        f_bond_only = torch.cat([f_bond_only.new_zeros(1, BOND_FDIM), f_bond_only], dim=0)
+        if self.atom_messages:
+            return f_atoms, f_bond_only
+        return f_atoms, torch.cat([f_atoms[b2a], f_bond_only], dim=1)
+
     def get_b2b(self) -> torch.LongTensor:
         """
         Computes (if necessary) and returns a mapping from each bond index to all the incoming bond indices.
@@ -413,26 +503,123 @@ class BatchMolGraph:
 
         return self.a2a
     
+def hot_indices(onehot: np.ndarray) -> np.ndarray:
+    """
+    Lists the hot columns of every row of a 0/1 feature matrix.
+
+    :param onehot: A [n, width] array of zeros and ones, width < 256.
+    :return: A uint8 [n, max hot columns per row] array, padded with width.
+    """
+    n, width = onehot.shape
+    rows, cols = np.nonzero(onehot)
+    n_hot = np.bincount(rows, minlength=n)
+    position = np.arange(len(rows)) - (np.cumsum(n_hot) - n_hot)[rows]
+    index = np.full((n, max(1, int(n_hot.max(initial=0)))), width, dtype=np.uint8)
+    index[rows, position] = cols
+    return index
+
+
+def scatter_hot(index: torch.Tensor, width: int) -> torch.FloatTensor:
+    """
+    Inverts hot_indices on the device of index.
+
+    :param index: An [n, k] tensor of hot columns, padded with width.
+    :param width: The number of feature columns.
+    :return: A float [n, width] tensor of zeros and ones.
+    """
+    dense = torch.zeros(index.shape[0], width + 1, device=index.device)
+    dense.scatter_(1, index.long(), 1.)
+    return dense[:, :width]
+
+
+def graph_key(smiles: str, prompt: bool, atom_messages: bool) -> str:
+    """
+    Computes the content key of a molecule under the given featurization settings.
+
+    The key is a hash of the SMILES as written, not of its canonical form: the atoms of a graph are in
+    the order of its SMILES, which the BatchGRU of the encoder depends on, so every spelling of a
+    molecule has a graph of its own.
+
+    :param smiles: A smiles string.
+    :param prompt: Whether the graph is featurized in prompt mode.
+    :param atom_messages: Whether bond features exclude the source atom features.
+    :return: A hex digest identifying the featurized graph.
+    """
+    content = f'{GRAPH_VERSION}|{smiles}|prompt={int(prompt)}|atom_messages={int(atom_messages)}'
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_mol_graph(smiles: str, args: Namespace, prompt: bool) -> MolGraph:
+    """
+    Returns the MolGraph of a molecule, looking it up in the in-memory LRU and then in the
+    on-disk GraphStore before featurizing it with RDKit.
+
+    :param smiles: A smiles string.
+    :param args: Arguments.
+    :param prompt: Whether to featurize in prompt mode.
+    :return: The MolGraph of the molecule.
+    """
+    global SMILES_TO_GRAPH, GRAPH_STORE
+    if args.no_cache:
+        return MolGraph(smiles, args, prompt)
+    if SMILES_TO_GRAPH is None:
+        SMILES_TO_GRAPH = LRUCache(args.graph_cache_size)
+        if args.graph_cache_path is not None:
+            GRAPH_STORE = GraphStore(args.graph_cache_path)
+
+    # the LRU and the store share the key
+    key = graph_key(smiles, prompt, args.atom_messages)
+    mol_graph = SMILES_TO_GRAPH.get(key)
+    if mol_graph is not None:
+        return mol_graph
+
+    if GRAPH_STORE is not None:
+        arrays = GRAPH_STORE.get(key)
+        if arrays is not None:
+            mol_graph = MolGraph.from_arrays(smiles, prompt, arrays)
+        else:
+            mol_graph = MolGraph(smiles, args, prompt)
+            GRAPH_STORE.put(key, mol_graph.to_arrays())
+    else:
+        mol_graph = MolGraph(smiles, args, prompt)
+    SMILES_TO_GRAPH.put(key, mol_graph)
+    return mol_graph
+
+
+def unique_molecules(smiles_batch) -> Tuple[list, List[int]]:
+    """
+    Finds the distinct molecules of a batch, e.g. a compound measured against several proteins.
+
+    :param smiles_batch: A list of SMILES strings or MolGraphs.
+    :return: The distinct molecules in order of first appearance, and the index of every row's molecule among them.
+    """
+    index, molecules, row_index = {}, [], []
+    for smiles in smiles_batch:
+        key = smiles.smiles if isinstance(smiles, MolGraph) else smiles
+        if key not in index:
+            index[key] = len(molecules)
+            molecules.append(smiles)
+        row_index.append(index[key])
+    return molecules, row_index
+
+
 def mol2graph(smiles_batch: List[str],
               args: Namespace, prompt: bool) -> BatchMolGraph:
     """
     Converts a list of SMILES strings to a BatchMolGraph containing the batch of molecular graphs.
 
-    :param smiles_batch: A list of SMILES strings.
+    :param smiles_batch: A list of SMILES strings, or of MolGraphs that are already featurized.
     :param args: Arguments.
     :return: A BatchMolGraph containing the combined molecular graph for the molecules
     """
     mol_graphs = []
     for smiles in smiles_batch:
-        # if smiles in SMILES_TO_GRAPH:
-        #     mol_graph = SMILES_TO_GRAPH[smiles]
-        # else:
-        if args.baseline_model == 'KANO':
-            mol_graph = MolGraph(smiles[0], args, prompt)
+        if isinstance(smiles, MolGraph):
+            mol_graph = smiles
+        elif args.baseline_model == 'KANO':
+            mol_graph = get_mol_graph(smiles[0], args, prompt)
         else:
-            mol_graph = MolGraph(smiles, args, prompt)
-            # if not args.no_cache:
-            #     SMILES_TO_GRAPH[smiles] = mol_graph
+            mol_graph = get_mol_graph(smiles, args, prompt)
         mol_graphs.append(mol_graph)
 
     return BatchMolGraph(mol_graphs, args)
@@ -521,8 +708,14 @@ def set_seed(random_seed):
     torch.cuda.manual_seed_all(random_seed)
 
 
+STANDARDIZER = None  # molvs.Standardizer of this process, created on first use
+
+
 def check_molecule(smiles):
-    mol = molvs.Standardizer().standardize(Chem.MolFromSmiles(smiles))
+    global STANDARDIZER
+    if STANDARDIZER is None:
+        STANDARDIZER = molvs.Standardizer()
+    mol = STANDARDIZER.standardize(Chem.MolFromSmiles(smiles))
 
     if mol is None:
         return False
@@ -1,3 +1,4 @@
+import os
 import argparse
 import torch
 from chemprop.features import get_available_features_generators
@@ -17,7 +18,8 @@ def add_args():
                         help='Turn off cuda')
     parser.add_argument('--mode', type=str, default='train',
                         choices=['train', 'inference', 'retrain', 'finetune',
-                                 'baseline_QSAR', 'baseline_CPI', 'baseline_inference'],
+                                 'baseline_QSAR', 'baseline_CPI', 'baseline_inference', 'featurize', 'compile',
+                                 'quantize', 'export_onnx'],
                         help='Mode to run script in')
     parser.add_argument('--print', action='store_true', default=False,
                         help='Print log')
@@ -53,7 +55,45 @@ def add_args():
                         help='Turn off scaling of features')
     parser.add_argument('--max_data_size', type=int, default=None,
                         help='Maximum number of data points to load')
-    
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='Turn off caching of featurized molecular graphs')
+    parser.add_argument('--graph_cache_path', type=str, default='data/graph_cache',
+                        help='Directory of the persistent molecular graph cache, '
+                             'set to None to only cache graphs in memory')
+    parser.add_argument('--graph_cache_size', type=int, default=100000,
+                        help='Maximum number of molecular graphs kept in memory')
+    parser.add_argument('--protein_store_path', type=str, default='data/protein_store',
+                        help='Directory of the memory-mapped protein feature store, proteins missing from it '
+                             'are loaded from data/Protein_pretrained_feat, set to None to only use the pickles')
+    parser.add_argument('--protein_cache_mb', type=float, default=None,
+                        help='Memory budget in MB of the protein graphs kept in memory once loaded '
+                             '(least recently used first out), no limit by default')
+    parser.add_argument('--encoded_protein_cache_mb', type=float, default=1024,
+                        help='Memory budget in MB of the proteins encoded by the model in inference '
+                             '(least recently used first out)')
+    parser.add_argument('--featurized_path', type=str, default=None,
+                        help='Directory of a dataset featurized with --mode featurize, to train or infer with KANO_Prot '
+                             'from it without featurizing again (default in featurize mode: data/featurized/<data_name>)')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Number of processes featurizing molecules, ahead of the model in training and '
+                             'inference and in --mode featurize, 0 featurizes them in the main process')
+    parser.add_argument('--standardize_workers', type=int, default=0,
+                        help='Number of processes standardizing the SMILES of a dataset, 0 standardizes them '
+                             'in the main process')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='Number of batches featurized ahead when num_workers > 0')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='Run the forward pass of training and inference in float32, or in bfloat16 '
+                             'with autocast (no loss scaling needed, experimental: compare it with fp32 '
+                             'by benchmark.py precision before relying on it)')
+    parser.add_argument('--int8', action='store_true', default=False,
+                        help='Run inference on CPU with the int8 model saved by --mode quantize')
+    parser.add_argument('--quantize_gru', action='store_true', default=False,
+                        help='Quantize the GRU of the molecule encoder along with its linear layers in --mode quantize')
+    parser.add_argument('--feature_encoding', type=str, default='onehot', choices=['onehot', 'index'],
+                        help='Send dense atom/bond features to the model (onehot), or only the indices of '
+                             'their hot columns and expand them on the device (index, not used with prompt)')
+
     # training arguments
     parser.add_argument('--checkpoint_path', type=str,
                         default='KANO_model/dumped/pretrained_graph_encoder/original_CMPN_0623_1350_14000th_epoch.pkl',
@@ -68,6 +108,13 @@ def add_args():
                         help='Number of siamese pairs')
     parser.add_argument('--batch_size', type=int, default=512,
                         help='Batch size')
+    parser.add_argument('--batch_sampler', type=str, default='random', choices=['random', 'protein'],
+                        help='Order of the training rows: shuffled (random) or batched by protein (protein), '
+                             'so that each protein of a batch is encoded once for all its ligands '
+                             '(experimental: compare its convergence with random by benchmark.py sampler '
+                             'before relying on it)')
+    parser.add_argument('--proteins_per_batch', type=int, default=8,
+                        help='Maximum number of proteins per training batch with --batch_sampler protein')
     parser.add_argument('--epochs', type=int, default=100,
                         help='Number of epochs')
     parser.add_argument('--lr', type=float, default=1e-4,
@@ -105,13 +152,29 @@ def add_args():
     parser.add_argument('--step', type=str, default='functional_prompt')
     parser.add_argument('--num_heads', type=int, default=5)
     parser.add_argument('--pooling', type=str, default='cross_attn', choices=['cross_attn', 'mean'])
+    parser.add_argument('--legacy_attn_mask', action='store_true', default=False,
+                        help='Fill padded cross-attention scores with 1e-8 instead of masking padded residues, '
+                             'to reproduce models trained before the key mask (checkpoints apply the masking '
+                             'they were trained with when loaded)')
 
     args = parser.parse_args()
     # add and modify some args
+    if args.graph_cache_path == 'None':
+        args.graph_cache_path = None
+    if args.protein_store_path == 'None':
+        args.protein_store_path = None
     if '.csv' not in args.data_path:
         args.data_path += '.csv'
     args.endpoint_type = args.data_path.split('/')[1]
     args.data_name = args.data_path.split('/')[-1].split('.')[0]
+    if args.mode == 'featurize' and args.featurized_path is None:
+        args.featurized_path = os.path.join('data', 'featurized', args.data_name)
+    if args.featurized_path is not None and args.mode.startswith('baseline'):
+        parser.error(f'--featurized_path holds the graphs of KANO_Prot, it cannot be used in --mode {args.mode}')
+    if args.int8 and args.precision != 'fp32':
+        parser.error('--int8 runs in float32 on CPU, it cannot be combined with --precision bf16')
+    if args.proteins_per_batch < 1:
+        parser.error('--proteins_per_batch must be at least 1')
     if not args.no_cuda and torch.cuda.is_available():
         args.cuda = True
     else:
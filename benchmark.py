@@ -0,0 +1,239 @@
+"""
+Benchmarks of the CPI model on the test set of a dataset.
+
+Usage: python benchmark.py <benchmark> [main.py arguments]
+
+    precision   RMSE, cliff RMSE and run time of the test predictions of a trained model
+                (--model_path, --ref_path) in fp32 and bf16
+    compile     Throughput of the test predictions of a trained model, eager and compiled with
+                --mode compile (compiled first if needed)
+    quantize    RMSE, cliff RMSE and run time of the test predictions of a trained model in fp32
+                and int8 with --mode quantize (quantized first if needed)
+    protein_cache
+                Test predictions of a trained model with and without the encoded protein cache, with
+                and without --legacy_attn_mask, which must not differ
+    sampler     Time per epoch and test RMSE after every epoch of a model trained from scratch for
+                --epochs epochs with --batch_sampler random and protein
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from chemprop.data import StandardScaler
+from torch.optim.lr_scheduler import ExponentialLR
+from MoleculeACE.benchmark.utils import calc_rmse, calc_cliff_rmse
+
+from args import add_args
+from data_prep import process_data_CPI, load_featurized_CPI
+from utils import set_up, set_seed, get_protein_feature
+from main import set_up_inference
+from model.train_val import train_epoch, predict_epoch
+from model.utils import set_up_model
+from model.models import encoded_protein_cache
+from model.compiled import compile_model, load_compiled_model
+from model.quantized import quantized_is_current, save_quantized_model, load_quantized_model
+
+
+def load_test_CPI(args, compiled=False):
+    """
+    Loads a trained model (eager unless compiled) and the test set of args.data_path as predict_main does.
+
+    :return: The logger, test DataFrame, model, protein graphs, test queries, test protein ids and scaler.
+    """
+    args.mode = 'inference'
+    args.int8 = False
+    args, logger = set_up(args)
+    if args.featurized_path is not None:
+        df_all, mol_graphs, data = load_featurized_CPI(args, logger)
+    else:
+        df_all = process_data_CPI(args, logger)[0]
+        mol_graphs = data = None
+    model, prot_graph_dict, query_test, test_prot, scaler = set_up_inference(args, logger, df_all,
+                                                                             mol_graphs, data, compiled)
+    test_df = df_all[df_all['split'] == 'test']
+    return logger, test_df, model, prot_graph_dict, query_test, test_prot, scaler
+
+
+def load_train_CPI(args):
+    """
+    Loads the train and test sets of args.data_path to train a model from scratch, without validation set.
+
+    :return: The logger, test DataFrame, protein graphs, train queries (with scaled labels) and protein ids,
+             test queries and protein ids and the label scaler.
+    """
+    args.mode = 'train'
+    args, logger = set_up(args)
+    df_all = process_data_CPI(args, logger)[0]
+    train_df, test_df = df_all[df_all['split'] == 'train'], df_all[df_all['split'] == 'test']
+    scaler = StandardScaler().fit(train_df[['y']].values)
+    query_train = [train_df['smiles'].values, scaler.transform(train_df[['y']].values).flatten()]
+    query_test = [test_df['smiles'].values, test_df['y'].values]
+    args.train_data_size = len(train_df)
+    prot_graph_dict = get_protein_feature(args, logger, df_all)
+    return logger, test_df, prot_graph_dict, query_train, train_df['Uniprot_id'].values, \
+           query_test, test_df['Uniprot_id'].values, scaler
+
+
+def score_predictions(test_df, pred):
+    pred = np.array(pred).flatten()[:len(test_df)]
+    rmse = calc_rmse(test_df['y'].values, pred)
+    rmse_cliff = calc_cliff_rmse(y_test_pred=pred, y_test=test_df['y'].values,
+                                 cliff_mols_test=test_df['cliff_mol'].values)
+    return pred, rmse, rmse_cliff
+
+
+def timed_predict(args, model, prot_graph_dict, query_test, test_prot, scaler):
+    # the proteins are encoded again in every pass
+    if hasattr(model, 'invalidate_protein_cache'):
+        model.invalidate_protein_cache()
+    start = time.time()
+    pred, _ = predict_epoch(args, model, prot_graph_dict, query_test, test_prot, None, scaler)
+    return pred, time.time() - start
+
+
+def benchmark_precision(args):
+    logger, test_df, model, prot_graph_dict, query_test, test_prot, scaler = load_test_CPI(args)
+    # featurize the test molecules once so that neither precision pays for it
+    args.precision = 'fp32'
+    predict_epoch(args, model, prot_graph_dict, query_test, test_prot, None, scaler)
+
+    results, preds = [], {}
+    for precision in ['fp32', 'bf16']:
+        args.precision = precision
+        pred, seconds = timed_predict(args, model, prot_graph_dict, query_test, test_prot, scaler)
+        preds[precision], rmse, rmse_cliff = score_predictions(test_df, pred)
+        results.append({'precision': precision, 'rmse': rmse, 'rmse_cliff': rmse_cliff,
+                        'max_abs_diff': np.abs(preds[precision] - preds['fp32']).max(),
+                        'seconds': seconds})
+    results = pd.DataFrame(results)
+    results['rmse_delta'] = results['rmse'] - results.loc[0, 'rmse']
+    results['rmse_cliff_delta'] = results['rmse_cliff'] - results.loc[0, 'rmse_cliff']
+    results['speedup'] = results.loc[0, 'seconds'] / results['seconds']
+
+    save_path = os.path.join(args.save_path, f'{args.data_name}_precision_benchmark.csv')
+    results.to_csv(save_path, index=False)
+    logger.info(f'precision benchmark saved in {save_path}\n{results.to_string(index=False)}')
+
+
+def benchmark_compile(args):
+    logger, test_df, model, prot_graph_dict, query_test, test_prot, scaler = load_test_CPI(args)
+    compiled = load_compiled_model(args, logger)
+    if compiled is None:
+        compile_model(args, model, prot_graph_dict, query_test[0], test_prot)
+        compiled = load_compiled_model(args, logger)
+    # featurize the test molecules once so that neither model pays for it
+    predict_epoch(args, model, prot_graph_dict, query_test, test_prot, None, scaler)
+
+    results, preds = [], {}
+    for name, cur_model in [('eager', model), ('compiled', compiled)]:
+        pred, seconds = timed_predict(args, cur_model, prot_graph_dict, query_test, test_prot, scaler)
+        preds[name], rmse, rmse_cliff = score_predictions(test_df, pred)
+        results.append({'model': name, 'rmse': rmse, 'rmse_cliff': rmse_cliff,
+                        'max_abs_diff': np.abs(preds[name] - preds['eager']).max(),
+                        'seconds': seconds, 'rows_per_second': len(test_df) / seconds})
+    results = pd.DataFrame(results)
+    results['speedup'] = results.loc[0, 'seconds'] / results['seconds']
+
+    save_path = os.path.join(args.save_path, f'{args.data_name}_compile_benchmark.csv')
+    results.to_csv(save_path, index=False)
+    logger.info(f'compile benchmark saved in {save_path}\n{results.to_string(index=False)}')
+
+
+def benchmark_quantize(args):
+    logger, test_df, model, prot_graph_dict, query_test, test_prot, scaler = load_test_CPI(args)
+    # quantize_dynamic copies the model, the fp32 one is left as it is
+    if quantized_is_current(args):
+        int8_model = load_quantized_model(args, model, logger)
+    else:
+        int8_model = save_quantized_model(args, model, logger)
+    # featurize the test molecules once so that neither model pays for it
+    predict_epoch(args, model, prot_graph_dict, query_test, test_prot, None, scaler)
+
+    results, preds = [], {}
+    for name, cur_model in [('fp32', model), ('int8', int8_model)]:
+        pred, seconds = timed_predict(args, cur_model, prot_graph_dict, query_test, test_prot, scaler)
+        preds[name], rmse, rmse_cliff = score_predictions(test_df, pred)
+        results.append({'model': name, 'rmse': rmse, 'rmse_cliff': rmse_cliff,
+                        'max_abs_diff': np.abs(preds[name] - preds['fp32']).max(),
+                        'seconds': seconds, 'rows_per_second': len(test_df) / seconds})
+    results = pd.DataFrame(results)
+    results['rmse_delta'] = results['rmse'] - results.loc[0, 'rmse']
+    results['rmse_cliff_delta'] = results['rmse_cliff'] - results.loc[0, 'rmse_cliff']
+    results['speedup'] = results.loc[0, 'seconds'] / results['seconds']
+
+    save_path = os.path.join(args.save_path, f'{args.data_name}_quantize_benchmark.csv')
+    results.to_csv(save_path, index=False)
+    logger.info(f'quantize benchmark saved in {save_path}\n{results.to_string(index=False)}')
+
+
+def benchmark_protein_cache(args):
+    logger, test_df, model, prot_graph_dict, query_test, test_prot, scaler = load_test_CPI(args)
+    # featurize the test molecules once so that no pass pays for it
+    predict_epoch(args, model, prot_graph_dict, query_test, test_prot, None, scaler)
+
+    results, preds = [], {}
+    cache_mb = args.encoded_protein_cache_mb
+    for legacy_mask in [False, True]:
+        model.cross_attn_pooling.legacy_mask = legacy_mask
+        # without a budget, the proteins of every batch are encoded and used as they are
+        for name, budget in [('uncached', 0), ('cached', cache_mb)]:
+            args.encoded_protein_cache_mb = budget
+            model.protein_cache = encoded_protein_cache(args)
+            pred, seconds = timed_predict(args, model, prot_graph_dict, query_test, test_prot, scaler)
+            preds[name], rmse, rmse_cliff = score_predictions(test_df, pred)
+            results.append({'legacy_attn_mask': legacy_mask, 'cache': name, 'rmse': rmse, 'rmse_cliff': rmse_cliff,
+                            'max_abs_diff': np.abs(preds[name] - preds['uncached']).max(), 'seconds': seconds})
+    args.encoded_protein_cache_mb = cache_mb
+    model.cross_attn_pooling.legacy_mask = args.legacy_attn_mask
+    results = pd.DataFrame(results)
+
+    save_path = os.path.join(args.save_path, f'{args.data_name}_protein_cache_benchmark.csv')
+    results.to_csv(save_path, index=False)
+    logger.info(f'protein cache benchmark saved in {save_path}\n{results.to_string(index=False)}')
+
+
+def benchmark_sampler(args):
+    logger, test_df, prot_graph_dict, query_train, train_prot, query_test, test_prot, scaler = load_train_CPI(args)
+
+    results = []
+    for sampler in ['random', 'protein']:
+        args.batch_sampler = sampler
+        # both samplers start from the same weights
+        set_seed(args.seed)
+        args, model, optimizer, scheduler, loss_func = set_up_model(args, logger)
+        if sampler == 'random':
+            # featurize the molecules and load the proteins once so that neither sampler pays for it
+            predict_epoch(args, model, prot_graph_dict, query_train, train_prot, None, None)
+        n_iter = 0
+        for epoch in range(args.epochs):
+            start = time.time()
+            n_iter, loss_collect = train_epoch(args, model, prot_graph_dict, query_train, train_prot, None,
+                                               loss_func, optimizer, scheduler, n_iter, epoch)
+            seconds = time.time() - start
+            if isinstance(scheduler, ExponentialLR):
+                scheduler.step()
+            pred, _ = timed_predict(args, model, prot_graph_dict, query_test, test_prot, scaler)
+            _, rmse, rmse_cliff = score_predictions(test_df, pred)
+            results.append({'sampler': sampler, 'epoch': epoch, 'train_mse': loss_collect['MSE'],
+                            'rmse': rmse, 'rmse_cliff': rmse_cliff, 'seconds': seconds})
+            logger.info(f'{sampler} sampler, epoch {epoch:02d}: {seconds:.1f} s, test RMSE {rmse:.3f}')
+    results = pd.DataFrame(results)
+    epoch_seconds = results.groupby('sampler')['seconds'].mean()
+    results['speedup'] = epoch_seconds['random'] / results['sampler'].map(epoch_seconds)
+
+    save_path = os.path.join(args.save_path, f'{args.data_name}_sampler_benchmark.csv')
+    results.to_csv(save_path, index=False)
+    logger.info(f'sampler benchmark saved in {save_path}\n{results.to_string(index=False)}')
+
+
+BENCHMARKS = {'precision': benchmark_precision, 'compile': benchmark_compile, 'quantize': benchmark_quantize,
+              'protein_cache': benchmark_protein_cache, 'sampler': benchmark_sampler}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        sys.exit(f'usage: python benchmark.py {{{",".join(BENCHMARKS)}}} [main.py arguments]')
+    # the remaining arguments are those of main.py
+    benchmark = BENCHMARKS[sys.argv.pop(1)]
+    benchmark(add_args())
@@ -11,12 +11,13 @@ A collection of data-prepping functions
 """
 
 import os
+import json
 import pickle
 from MoleculeACE.benchmark.cliffs import ActivityCliffs, get_tanimoto_matrix, \
                                         moleculeace_similarity, get_fc
 from sklearn.cluster import SpectralClustering
 from sklearn.model_selection import train_test_split
-from chemprop.data import MoleculeDataset
+from chemprop.data import MoleculeDataset, MoleculeDatapoint
 from typing import List
 import pandas as pd
 import numpy as np
@@ -24,7 +25,7 @@ import random
 import torch
 from tqdm import tqdm
 from chemprop.data.utils import get_data, get_task_names
-from utils import check_molecule, chembl_to_uniprot, get_protein_sequence, \
+from utils import standardize_smiles, chembl_to_uniprot, get_protein_sequence, \
                   get_molecule_feature, get_protein_feature, generate_onehot_features
 from DeepPurpose.utils import encode_drug, encode_protein
 from rdkit import Chem
@@ -33,8 +34,25 @@ import networkx as nx
 from torch.utils import data
 from torch_geometric.data import DataLoader
 from CPI_baseline.utils import TestbedDataset, MolTrans_Data_Encoder
+from KANO_model.graph_cache import GraphStore
+from KANO_model.utils import MolGraph, graph_key, GRAPH_VERSION
     
 
+def validation_idx(df_data, args):
+    """
+    Returns the validation rows of a CPI dataset, sampled from its training rows.
+
+    A featurized dataset keeps the rows sampled when it was featurized (the is_val column of rows.pkl).
+    Otherwise they are drawn with the global random module seeded by set_up, so every call draws other rows.
+
+    :return: A list of row indices.
+    """
+    if 'is_val' in df_data.columns:
+        return list(df_data[df_data['is_val']].index)
+    train_idx = df_data[df_data['split'] == 'train'].index
+    return random.sample(list(train_idx), int(len(df_data) * args.split_sizes[1]))
+
+
 def process_data_CPI(args, logger):
     args.smiles_columns = ['smiles']
     args.target_columns = ['y']
@@ -56,7 +74,8 @@ def process_data_CPI(args, logger):
         # logger.info(f'Integrating data from {datadir}...')
         for assay_name in dataset:
             df = pd.read_csv(f'data/{datadir}/{assay_name}.csv')
-            df[args.smiles_columns] = df[args.smiles_columns].applymap(check_molecule)
+            for column in args.smiles_columns:
+                df[column] = standardize_smiles(df[column], num_workers=args.standardize_workers)
             df = df.dropna(subset=args.smiles_columns)
 
             if 'split' not in df.columns and 'cliff_mol' not in df.columns:
@@ -100,12 +119,16 @@ def process_data_CPI(args, logger):
     y = df_data['y'].values
     train_idx, test_idx = list(df_data[df_data['split'].values == 'train'].index), \
                         list(df_data[df_data['split'].values == 'test'].index)
-    val_idx = random.sample(list(train_idx), int(len(df_data) * valid_ratio))
+    val_idx = validation_idx(df_data, args)
     train_idx = list(set(train_idx) - set(val_idx))
     if args.print:
         logger.info(f'total size: {len(df_data)}, train size: {len(train_idx)}, '
                     f'val size: {len(val_idx)}, test size: {len(test_idx)}')
 
+    if args.mode == 'featurize':
+        # the molecules are featurized by featurize_data_CPI
+        return df_data, test_idx, None, None, None
+
     if args.mode in ['train', 'inference', 'retrain', 'finetune'] \
         and args.train_model in ['KANO_Prot', 'KANO_ESM']:
         # get data from csv file
@@ -119,7 +142,7 @@ def process_data_CPI(args, logger):
         # split data by MoleculeACE
         if args.split_sizes:
             train_idx, test_idx = df_data[df_data['split']=='train'].index, df_data[df_data['split']=='test'].index
-            val_idx = random.sample(list(train_idx), int(len(df_data) * valid_ratio))
+            val_idx = validation_idx(df_data, args)
             train_idx = list(set(train_idx) - set(val_idx))
         train_data, val_data, test_data = tuple([[data[i] for i in train_idx],
                                             [data[i] for i in val_idx] if len(val_idx) > 0 else [],
@@ -349,10 +372,89 @@ def process_data_CPI(args, logger):
     return df_data, test_idx, train_data, val_data, test_data
 
 
+def featurize_molecule(smiles, args):
+    # KANO_Prot always encodes molecules with prompt=False
+    return MolGraph(smiles, args, False).to_arrays()
+
+
+def featurize_data_CPI(args, logger):
+    """ Featurize a CPI dataset once into args.featurized_path.
+
+    The directory holds the rows of the dataset (rows.pkl, with the labels, split, validation rows,
+    cliff flags, protein IDs and the graph key of every molecule), the molecular graphs in a sharded
+    GraphStore (graphs/), and the settings they were featurized with (meta.json).
+
+    :param args: Namespace object
+    :param logger: logger object
+    """
+    df_data, _, _, _, _ = process_data_CPI(args, logger)
+    # the validation rows are fixed here, training on the featurized dataset reads them back. Training from
+    # the CSV samples them three times (twice in process_data_CPI and once in run_CPI) and uses the last ones,
+    # process_data_CPI sampled once in featurize mode
+    validation_idx(df_data, args)
+    df_data['is_val'] = df_data.index.isin(validation_idx(df_data, args))
+    smiles = df_data['smiles'].unique()
+    keys = dict(zip(smiles, [graph_key(smi, False, args.atom_messages) for smi in smiles]))
+    df_data['graph_key'] = df_data['smiles'].map(keys)
+
+    store = GraphStore(os.path.join(args.featurized_path, 'graphs'))
+    new_smiles = list({key: smi for smi, key in keys.items() if key not in store}.values())
+    logger.info(f'featurizing {len(new_smiles)} molecules into {args.featurized_path}...') if args.print else None
+    if args.num_workers > 0:
+        from concurrent.futures import ProcessPoolExecutor
+        from functools import partial
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            graphs = executor.map(partial(featurize_molecule, args=args), new_smiles,
+                                  chunksize=max(1, len(new_smiles) // (args.num_workers * 16)))
+            for smi, arrays in zip(new_smiles, tqdm(graphs, total=len(new_smiles))):
+                store.put(keys[smi], arrays)
+    else:
+        for smi in tqdm(new_smiles):
+            store.put(keys[smi], featurize_molecule(smi, args))
+    store.flush()
+
+    df_data.to_pickle(os.path.join(args.featurized_path, 'rows.pkl'))
+    with open(os.path.join(args.featurized_path, 'meta.json'), 'w') as f:
+        json.dump({'data_path': args.data_path, 'graph_version': GRAPH_VERSION,
+                   'atom_messages': args.atom_messages}, f)
+    logger.info(f'saved {len(df_data)} rows and {len(store)} molecules '
+                f'to {args.featurized_path}') if args.print else None
+
+
+def load_featurized_CPI(args, logger):
+    """ Load a CPI dataset written by featurize_data_CPI without RDKit.
+
+    :param args: Namespace object
+    :param logger: logger object
+    :return: df_data, the MolGraph of every row, and a MoleculeDataset of the smiles and labels
+    """
+    with open(os.path.join(args.featurized_path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta['graph_version'] != GRAPH_VERSION or meta['atom_messages'] != args.atom_messages:
+        raise ValueError(f'{args.featurized_path} was featurized with different settings {meta}, '
+                         f'please run --mode featurize again')
+    logger.info(f'Loading featurized data from {args.featurized_path}') if args.print else None
+    args.smiles_columns = ['smiles']
+    args.target_columns = ['y']
+    args.task_names = ['y']
+    args.ignore_columns = None
+
+    df_data = pd.read_pickle(os.path.join(args.featurized_path, 'rows.pkl'))
+    keys = df_data.pop('graph_key')
+    store = GraphStore(os.path.join(args.featurized_path, 'graphs'))
+    graphs = {key: MolGraph.from_arrays(smi, False, store.get(key))
+              for key, smi in dict(zip(keys, df_data['smiles'])).items()}
+    mol_graphs = np.empty(len(df_data), dtype=object)
+    mol_graphs[:] = [graphs[key] for key in keys]
+    data = MoleculeDataset([MoleculeDatapoint(smiles=[smi], targets=[float(y)])
+                            for smi, y in zip(df_data['smiles'], df_data['y'])])
+    return df_data, mol_graphs, data
+
+
 def process_data_QSAR(args, logger):
     # check the validity of SMILES
     df = pd.read_csv(args.data_path)
-    df[args.smiles_columns] = df[args.smiles_columns].apply(check_molecule)
+    df[args.smiles_columns] = standardize_smiles(df[args.smiles_columns], num_workers=args.standardize_workers)
     df = df.dropna(subset=args.smiles_columns)
     df = df.reset_index(drop=True)
 
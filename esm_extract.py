@@ -0,0 +1,225 @@
+"""
+ESM-2 residue embeddings of protein sequences, written to <output_dir>/<prot_id>.npy.
+
+Usage: python esm_extract.py --data_path {CSV with Uniprot_id and Sequence columns} [--num_workers N]
+
+Sequences are sorted by length and batched under a token budget, without contact prediction. Sequences
+longer than the context of the model are embedded in overlapping windows, and the embeddings of a residue
+seen by several windows are averaged. Every protein is added to <output_dir>/manifest.jsonl once its
+embeddings are written, so an interrupted run resumes with the proteins that are not in it.
+"""
+import os
+import json
+import hashlib
+import argparse
+import multiprocessing as mp
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import esm
+import torch
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+ESM_MODEL = 'esm2_t33_650M_UR50D'
+ESM_EMB_DIR = 'data/esm_emb'
+MANIFEST = 'manifest.jsonl'
+# ESM-2 was trained on sequences of 1024 tokens, BOS and EOS included
+MAX_RESIDUES = 1022
+
+# the model of an extraction worker, set once by _init_worker
+_WORKER_MODEL = None
+
+
+def load_esm(model_name=ESM_MODEL, device='cpu'):
+    model, alphabet = getattr(esm.pretrained, model_name)()
+    return model.eval().to(device), alphabet
+
+
+def sequence_hash(sequence):
+    return hashlib.sha1(sequence.encode()).hexdigest()
+
+
+def embedding_path(output_dir, prot_id):
+    return os.path.join(output_dir, f'{prot_id}.npy')
+
+
+def sequence_windows(length, window=MAX_RESIDUES, overlap=256):
+    """
+    Splits a sequence into windows of window residues overlapping by at least overlap residues,
+    the last one ending at the end of the sequence.
+
+    :return: A list of (start, end) residue positions, a single one if the sequence fits in a window.
+    """
+    if length <= window:
+        return [(0, length)]
+    starts = list(range(0, length - window, window - overlap)) + [length - window]
+    return [(start, start + window) for start in starts]
+
+
+def token_batches(windows, tokens_per_batch):
+    """
+    Groups windows of similar lengths into batches whose padded tokens (BOS and EOS included)
+    fit in tokens_per_batch. A window longer than that makes a batch of its own.
+
+    :param windows: A list of (prot_id, start, end) windows.
+    :return: A list of batches of windows, the shortest first.
+    """
+    batches, batch, max_tokens = [], [], 0
+    for prot_id, start, end in sorted(windows, key=lambda w: w[2] - w[1]):
+        tokens = end - start + 2
+        if batch and max(max_tokens, tokens) * (len(batch) + 1) > tokens_per_batch:
+            batches.append(batch)
+            batch, max_tokens = [], 0
+        batch.append((prot_id, start, end))
+        max_tokens = max(max_tokens, tokens)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_batch(model, alphabet, batch):
+    """
+    Embeds a batch of windows with the last layer of model.
+
+    :param batch: A list of (label, sequence) windows.
+    :return: A list of [len(sequence), embed_dim] float32 embeddings, without BOS and EOS.
+    """
+    _, _, tokens = alphabet.get_batch_converter()(batch)
+    with torch.no_grad():
+        results = model(tokens.to(next(model.parameters()).device), repr_layers=[model.num_layers])
+    representations = results['representations'][model.num_layers]
+    return [representations[i, 1: len(sequence) + 1].float().cpu().numpy() for i, (_, sequence) in enumerate(batch)]
+
+
+def _init_worker(model_name, num_threads):
+    global _WORKER_MODEL
+    # the workers share the cores of the machine
+    torch.set_num_threads(num_threads)
+    _WORKER_MODEL = load_esm(model_name)
+
+
+def _embed_worker(batch):
+    return embed_batch(*_WORKER_MODEL, batch)
+
+
+def read_manifest(output_dir):
+    """
+    Reads the proteins written to output_dir.
+
+    :return: A dict of manifest entries by protein id, the last one of every protein.
+    """
+    manifest = {}
+    if not os.path.exists(os.path.join(output_dir, MANIFEST)):
+        return manifest
+    with open(os.path.join(output_dir, MANIFEST)) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run
+                continue
+            manifest[entry['prot_id']] = entry
+    return manifest
+
+
+def extract_embeddings(sequences, output_dir=ESM_EMB_DIR, model_name=ESM_MODEL, tokens_per_batch=4096,
+                       window=MAX_RESIDUES, overlap=256, num_workers=0):
+    """
+    Writes the ESM-2 embeddings of the sequences not in the manifest of output_dir yet (or whose sequence
+    or model changed) to <output_dir>/<prot_id>.npy.
+
+    :param sequences: A dict of protein sequences by protein id.
+    :param tokens_per_batch: The maximum number of padded tokens of a batch.
+    :param window: The maximum number of residues embedded at once.
+    :param overlap: The minimum number of residues shared by consecutive windows of a long sequence.
+    :param num_workers: The number of CPU processes embedding batches with a copy of the model each,
+                        0 to embed them in this process (on GPU if available).
+    :return: The manifest of output_dir.
+    """
+    if not 0 <= overlap < window:
+        raise ValueError(f'the overlap ({overlap}) must be smaller than the window ({window})')
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = read_manifest(output_dir)
+    todo = {prot_id: sequence for prot_id, sequence in sequences.items()
+            if prot_id not in manifest or manifest[prot_id]['sha1'] != sequence_hash(sequence)
+            or manifest[prot_id]['model'] != model_name or not os.path.exists(embedding_path(output_dir, prot_id))}
+    if not todo:
+        return manifest
+
+    windows = [(prot_id, start, end) for prot_id, sequence in todo.items()
+               for start, end in sequence_windows(len(sequence), window, overlap)]
+    batches = token_batches(windows, tokens_per_batch)
+    inputs = [[(f'{prot_id}:{start}', todo[prot_id][start:end]) for prot_id, start, end in batch] for batch in batches]
+    if num_workers > 0:
+        pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context('forkserver'),
+                                   initializer=_init_worker,
+                                   initargs=(model_name, max(os.cpu_count() // num_workers, 1)))
+        results = pool.map(_embed_worker, inputs)
+    else:
+        pool = None
+        model, alphabet = load_esm(model_name, torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+        results = (embed_batch(model, alphabet, batch) for batch in inputs)
+
+    # the windows of a protein are summed until the last one is embedded
+    remaining = Counter(prot_id for prot_id, _, _ in windows)
+    emb_sum, emb_count = {}, {}
+    with open(os.path.join(output_dir, MANIFEST), 'a+') as f:
+        f.seek(max(f.tell() - 1, 0))
+        if f.read(1) not in ['', '\n']:
+            # the last line of an interrupted run was cut short
+            f.write('\n')
+        for batch, embeddings in tqdm(zip(batches, results), total=len(batches), desc='ESM-2 embedding'):
+            for (prot_id, start, end), embedding in zip(batch, embeddings):
+                if prot_id not in emb_sum:
+                    emb_sum[prot_id] = np.zeros((len(todo[prot_id]), embedding.shape[1]), dtype=np.float32)
+                    emb_count[prot_id] = np.zeros((len(todo[prot_id]), 1), dtype=np.float32)
+                emb_sum[prot_id][start:end] += embedding
+                emb_count[prot_id][start:end] += 1
+                remaining[prot_id] -= 1
+                if remaining[prot_id] > 0:
+                    continue
+                # written under a temporary name first, so that an interrupted write is not taken as done
+                tmp_path = embedding_path(output_dir, prot_id) + '.tmp.npy'
+                np.save(tmp_path, emb_sum.pop(prot_id) / emb_count.pop(prot_id))
+                os.replace(tmp_path, embedding_path(output_dir, prot_id))
+                manifest[prot_id] = {'prot_id': prot_id, 'length': len(todo[prot_id]),
+                                     'sha1': sequence_hash(todo[prot_id]), 'model': model_name,
+                                     'windows': len(sequence_windows(len(todo[prot_id]), window, overlap))}
+                f.write(json.dumps(manifest[prot_id]) + '\n')
+                f.flush()
+    if pool is not None:
+        pool.shutdown()
+    return manifest
+
+
+def load_embedding(prot_id, output_dir=ESM_EMB_DIR):
+    """
+    :return: The [residues, embed_dim] ESM-2 embeddings of a protein written by extract_embeddings.
+    """
+    return np.load(embedding_path(output_dir, prot_id))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True,
+                        help='CSV file with Uniprot_id and Sequence columns')
+    parser.add_argument('--output_dir', type=str, default=ESM_EMB_DIR,
+                        help='Directory of the embeddings and their manifest')
+    parser.add_argument('--model', type=str, default=ESM_MODEL,
+                        choices=[name for name in dir(esm.pretrained) if name.startswith('esm2_')],
+                        help='ESM-2 model')
+    parser.add_argument('--tokens_per_batch', type=int, default=4096,
+                        help='Maximum number of padded tokens per batch')
+    parser.add_argument('--window', type=int, default=MAX_RESIDUES,
+                        help='Maximum number of residues embedded at once, longer sequences are windowed')
+    parser.add_argument('--overlap', type=int, default=256,
+                        help='Minimum number of residues shared by consecutive windows')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Number of CPU processes with a copy of the model, 0 to run in this process')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data_path).drop_duplicates('Uniprot_id')
+    manifest = extract_embeddings(dict(zip(df['Uniprot_id'], df['Sequence'])), args.output_dir, args.model,
+                                  args.tokens_per_batch, args.window, args.overlap, args.num_workers)
+    print(f'{len(manifest)} protein embeddings in {args.output_dir}')
@@ -11,28 +11,34 @@ from torch.optim.lr_scheduler import ExponentialLR
 from MoleculeACE.benchmark.utils import Data, calc_rmse, calc_cliff_rmse
 
 from args import add_args
-from data_prep import process_data_QSAR, process_data_CPI
+from data_prep import process_data_QSAR, process_data_CPI, featurize_data_CPI, load_featurized_CPI, validation_idx
 from utils import set_save_path, set_seed, set_collect_metric, \
                   collect_metric_epoch, save_checkpoint, \
                   define_logging, set_up, get_protein_feature
 from model.train_val import retrain_scheduler, train_epoch, evaluate_epoch, predict_epoch
 from model.utils import generate_siamse_smi, set_up_model
+from model.compiled import compile_model, load_compiled_model, export_onnx, onnx_path
+from model.quantized import save_quantized_model, load_quantized_model
 
 
 def run_CPI(args):
     args, logger = set_up(args)
 
-    df_all, test_idx, train_data, val_data, test_data = process_data_CPI(args, logger)
+    if args.featurized_path is not None:
+        df_all, mol_graphs, data = load_featurized_CPI(args, logger)
+    else:
+        df_all, test_idx, train_data, val_data, test_data = process_data_CPI(args, logger)
+        mol_graphs = None
 
-    data = get_data(path=args.data_path, 
-                    smiles_columns=args.smiles_columns,
-                    target_columns=args.target_columns,
-                    ignore_columns=args.ignore_columns)
+        data = get_data(path=args.data_path, 
+                        smiles_columns=args.smiles_columns,
+                        target_columns=args.target_columns,
+                        ignore_columns=args.ignore_columns)
 
     if args.split_sizes:
         _, valid_ratio, test_ratio = args.split_sizes
         train_idx, test_idx = df_all[df_all['split']=='train'].index, df_all[df_all['split']=='test'].index
-        val_idx = random.sample(list(train_idx), int(len(df_all) * valid_ratio))
+        val_idx = validation_idx(df_all, args)
         train_idx = list(set(train_idx) - set(val_idx))
 
     train_prot, val_prot, test_prot = df_all.loc[train_idx, 'Uniprot_id'].values, \
@@ -86,6 +92,12 @@ def run_CPI(args):
         # scaler = None
     query_test, siams_test = [np.array(test_data.smiles()).flatten(),
                                 np.array(test_data.targets()).flatten()], None
+    if mol_graphs is not None:
+        # feed the pre-featurized graphs to the model instead of SMILES
+        query_train[0] = mol_graphs[list(train_idx)]
+        if len(val_data) > 0:
+            query_val[0] = mol_graphs[list(val_idx)]
+        query_test[0] = mol_graphs[list(test_idx)]
     
     # load protein features
     if args.train_model in ['KANO_Prot', 'KANO_Prot_Siams', 'KANO_ESM']:
@@ -103,7 +115,14 @@ def run_CPI(args):
     for epoch in range(args.previous_epoch+1, args.epochs):
     # for epoch in range(args.epochs-1, args.epochs):
         n_iter, loss_collect = train_epoch(args, model, prot_graph_dict, query_train, train_prot, siams_train, 
-                                           loss_func, optimizer, scheduler, n_iter)
+                                           loss_func, optimizer, scheduler, n_iter, epoch)
+        # the evaluation passes below add to the counts of the model, only those of training are logged
+        dedup_counts = dict(model.dedup_counts)
+        logger.info('Epoch : {:02d}, encoded {} distinct molecules for {} rows, dedup ratio: {:.3f}'.format(
+                    epoch, dedup_counts['unique'], dedup_counts['rows'],
+                    dedup_counts['unique'] / max(dedup_counts['rows'], 1))) if args.print else None
+        logger.info(f'Epoch : {epoch:02d}, protein cache: {prot_graph_dict.stats()}') \
+            if args.print and prot_graph_dict is not None else None
         if isinstance(scheduler, ExponentialLR):
             scheduler.step()
 
@@ -360,34 +379,111 @@ def run_baseline_CPI(args):
     return
 
 
-def predict_main(args):
+def run_featurize(args):
     args, logger = set_up(args)
-    df_all, test_idx, _, _, test_data = process_data_CPI(args, logger)
-    if args.mode == 'inference':
+    featurize_data_CPI(args, logger)
+    logger.handlers.clear()
+    return
+
+
+def set_up_inference(args, logger, df_all, mol_graphs=None, data=None, compiled=True):
+    """
+    Loads the trained model of args.model_path with the test set and protein features for inference.
+
+    :param df_all: The DataFrame of the dataset.
+    :param mol_graphs: The MolGraph of every row, if the dataset was featurized ahead of time.
+    :param data: The MoleculeDataset of the featurized dataset.
+    :param compiled: Whether to use the model compiled with --mode compile, if there is one
+                     (ignored with --int8, which uses the model saved by --mode quantize).
+    :return: The model, protein graphs, test queries, test protein ids and label scaler.
+    """
+    if mol_graphs is None:
         data = get_data(path=args.data_path, 
                         smiles_columns=args.smiles_columns,
                         target_columns=args.target_columns,
                         ignore_columns=args.ignore_columns)
-        test_idx = df_all[df_all['split']=='test'].index
-        test_prot = df_all.loc[test_idx, 'Uniprot_id'].values
-        test_data = [data[i] for i in test_idx]
-        test_data = MoleculeDataset(test_data)
-        args.batch_size = 256
-        if args.dataset_type == 'regression':
-            ref_df = pd.read_csv(args.ref_path)
-            ref_y = ref_df['y'].values
-            scaler = StandardScaler().fit(ref_y)
-        else:
-            scaler = None
-        args.train_data_size = len(test_data)
-        args, model, optimizer, scheduler, loss_func = set_up_model(args, logger)
+    test_idx = df_all[df_all['split']=='test'].index
+    test_prot = df_all.loc[test_idx, 'Uniprot_id'].values
+    test_data = [data[i] for i in test_idx]
+    test_data = MoleculeDataset(test_data)
+    args.batch_size = 256
+    if args.dataset_type == 'regression':
+        ref_df = pd.read_csv(args.ref_path)
+        ref_y = ref_df['y'].values
+        scaler = StandardScaler().fit(ref_y)
+    else:
+        scaler = None
+    args.train_data_size = len(test_data)
+    args, model, optimizer, scheduler, loss_func = set_up_model(args, logger)
+    if args.int8:
+        model = load_quantized_model(args, model, logger)
+    elif compiled and args.train_model == 'KANO_Prot' and args.ablation == 'none':
+        compiled_model = load_compiled_model(args, logger)
+        if compiled_model is not None:
+            model = compiled_model
+
+    query_test = [np.array(test_data.smiles()).flatten(),
+                  np.array(test_data.targets()).flatten()]
+    if mol_graphs is not None:
+        query_test[0] = mol_graphs[list(test_idx)]
+    prot_graph_dict = get_protein_feature(args, logger, df_all)
+    return model, prot_graph_dict, query_test, test_prot, scaler
+
+
+def run_compile(args):
+    args, logger = set_up(args)
+    if args.featurized_path is not None:
+        df_all, mol_graphs, data = load_featurized_CPI(args, logger)
+    else:
+        df_all = process_data_CPI(args, logger)[0]
+        mol_graphs = data = None
+    model, prot_graph_dict, query_test, test_prot, _ = set_up_inference(args, logger, df_all, mol_graphs, data,
+                                                                        compiled=False)
+    compile_model(args, model, prot_graph_dict, query_test[0], test_prot)
+    logger.info(f'compiled model saved in {args.model_path}/compiled') if args.print else None
+    logger.handlers.clear()
+
+
+def run_export_onnx(args):
+    args, logger = set_up(args)
+    if args.featurized_path is not None:
+        df_all, mol_graphs, data = load_featurized_CPI(args, logger)
+    else:
+        df_all = process_data_CPI(args, logger)[0]
+        mol_graphs = data = None
+    model, prot_graph_dict, query_test, test_prot, scaler = set_up_inference(args, logger, df_all, mol_graphs, data,
+                                                                             compiled=False)
+    export_onnx(args, model, prot_graph_dict, query_test[0], test_prot, scaler)
+    logger.info(f'ONNX model saved in {onnx_path(args)}, run it with onnx_infer.py') if args.print else None
+    logger.handlers.clear()
 
-        query_test, siams_test = [np.array(test_data.smiles()).flatten(),
-                                  np.array(test_data.targets()).flatten()], None
-        prot_graph_dict = get_protein_feature(args, logger, df_all)
 
+def run_quantize(args):
+    args, logger = set_up(args)
+    if args.featurized_path is not None:
+        df_all, mol_graphs, data = load_featurized_CPI(args, logger)
+    else:
+        df_all = process_data_CPI(args, logger)[0]
+        mol_graphs = data = None
+    args.int8 = False
+    model = set_up_inference(args, logger, df_all, mol_graphs, data, compiled=False)[0]
+    save_quantized_model(args, model, logger)
+    logger.info(f'run benchmark.py quantize for its accuracy on the test set') if args.print else None
+    logger.handlers.clear()
+
+
+def predict_main(args):
+    args, logger = set_up(args)
+    if args.featurized_path is not None:
+        df_all, mol_graphs, data = load_featurized_CPI(args, logger)
+    else:
+        df_all, test_idx, _, _, test_data = process_data_CPI(args, logger)
+        mol_graphs = data = None
+    if args.mode == 'inference':
+        model, prot_graph_dict, query_test, test_prot, scaler = set_up_inference(args, logger, df_all,
+                                                                                 mol_graphs, data)
         test_pred, _ = predict_epoch(args, model, prot_graph_dict,
-                                     query_test, test_prot, siams_test, scaler)
+                                     query_test, test_prot, None, scaler)
         test_pred = np.array(test_pred).flatten()
         
     elif args.mode == 'baseline_inference':
@@ -463,6 +559,14 @@ if __name__ == '__main__':
 
     elif args.mode in ['inference', 'baseline_inference']:
         predict_main(args)
+    elif args.mode == 'featurize':
+        run_featurize(args)
+    elif args.mode == 'compile':
+        run_compile(args)
+    elif args.mode == 'quantize':
+        run_quantize(args)
+    elif args.mode == 'export_onnx':
+        run_export_onnx(args)
     elif args.mode == 'baseline_QSAR':
         run_baseline_QSAR(args)
     elif args.mode == 'baseline_CPI':
@@ -0,0 +1,267 @@
+import os
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+from torch_geometric.data import Batch
+
+from KANO_model.cmpn import encoder_inputs
+from KANO_model.utils import mol2graph, unique_molecules, funcgroups, fg2emb
+from model.layers import ProteinBatch, graph_readout, gather_keys
+from model.models import KANO_Prot, encode_molecules, encoded_protein_cache
+
+# the files of a compiled model in <model_path>/compiled
+STAGES = ['molecule', 'protein', 'keys', 'head']
+# the named inputs and outputs of the ONNX graphs of the stages, with their dynamic axes
+ONNX_INPUTS = {
+    'molecule': {'f_atoms': {0: 'n_atoms'}, 'f_bonds': {0: 'n_bonds'}, 'a2b': {0: 'n_atoms', 1: 'max_num_bonds'},
+                 'b2a': {0: 'n_bonds'}, 'b2revb': {0: 'n_bonds'}, 'f_fgs': {0: 'n_fgs'}, 'atom_num': {0: 'n_mols'},
+                 'cls_index': {0: 'n_mols'}, 'target_index': {0: 'n_fgs'}, 'mol_count': {0: 'n_mols'},
+                 'atom_index': {0: 'n_mol_atoms'}, 'mol_index': {0: 'n_mol_atoms'}, 'pos_index': {0: 'n_mol_atoms'},
+                 'atom_mask': {0: 'n_mols', 1: 'max_atoms'}},
+    'protein': {'x': {0: 'n_residues'}, 'edge_index': {1: 'n_edges'}},
+    'keys': {'prot_node_feat': {0: 'n_proteins', 1: 'max_residues'}},
+    'head': {'mol_feat': {0: 'n_rows'}, 'atom_feat': {0: 'n_rows', 1: 'max_atoms'},
+             'atom_mask': {0: 'n_rows', 1: 'max_atoms'}, 'prot_graph_feat': {0: 'n_rows'},
+             'keys': {0: 'n_rows', 2: 'max_residues'}, 'values': {0: 'n_rows', 2: 'max_residues'},
+             'prot_mask': {0: 'n_rows', 1: 'max_residues'}}}
+ONNX_OUTPUTS = {
+    'molecule': {'mol_feat': {0: 'n_mols'}, 'atom_feat': {0: 'n_mols', 1: 'max_atoms'},
+                 'padded_atom_mask': {0: 'n_mols', 1: 'max_atoms'}},
+    'protein': {'node_feat': {0: 'n_residues'}},
+    'keys': {'keys': {0: 'n_proteins', 2: 'max_residues'}, 'values': {0: 'n_proteins', 2: 'max_residues'}},
+    'head': {'output': {0: 'n_rows'}}}
+
+
+class MoleculeStage(nn.Module):
+    """The CMPN encoder of KANO_Prot, from the tensors of encoder_inputs to padded atom features."""
+
+    def __init__(self, model: KANO_Prot):
+        super(MoleculeStage, self).__init__()
+        self.encoder = model.molecule_encoder.encoder.encoder
+
+    def forward(self, *inputs):
+        return self.encoder.encode(*inputs, padded=True)
+
+
+class ProteinStage(nn.Module):
+    """The GCN of KANO_Prot, per residue."""
+
+    def __init__(self, model: KANO_Prot):
+        super(ProteinStage, self).__init__()
+        self.protein_encoder = model.protein_encoder
+
+    def forward(self, x, edge_index):
+        return self.protein_encoder.encode_nodes(x, edge_index)
+
+
+class KeysStage(nn.Module):
+    """
+    The key and value projections of the cross-attention of KANO_Prot, from padded residue features,
+    so that padded residues get the keys and values of a zero row as in KANO_Prot.
+    """
+
+    def __init__(self, model: KANO_Prot):
+        super(KeysStage, self).__init__()
+        self.cross_attn_pooling = model.cross_attn_pooling
+
+    def forward(self, prot_node_feat):
+        return self.cross_attn_pooling.project_keys(prot_node_feat)
+
+
+class HeadStage(nn.Module):
+    """The cross-attention pooling and feed-forward head of KANO_Prot."""
+
+    def __init__(self, model: KANO_Prot):
+        super(HeadStage, self).__init__()
+        self.cross_attn_pooling = model.cross_attn_pooling
+        self.ffn = model.molecule_encoder.ffn
+
+    def forward(self, mol_feat, atom_feat, atom_mask, prot_graph_feat, keys, values, prot_mask):
+        cmb_feat, _ = self.cross_attn_pooling(atom_feat, None, atom_mask, prot_mask, return_attention=False,
+                                              projected_keys=(keys, values))
+        return self.ffn(torch.concat([mol_feat, prot_graph_feat, cmb_feat], dim=1))
+
+
+class CompiledKANO_Prot(KANO_Prot):
+    """
+    KANO_Prot for inference with its molecule encoder, protein encoder and head traced by TorchScript.
+
+    Featurization, deduplication of molecules and the protein cache stay in Python as in KANO_Prot.
+    """
+
+    def __init__(self, args, molecule_stage, protein_stage, keys_stage, head_stage):
+        nn.Module.__init__(self)
+        self.args = args
+        self.molecule_stage = molecule_stage
+        self.protein_stage = protein_stage
+        self.keys_stage = keys_stage
+        self.head_stage = head_stage
+        self.dedup_counts = {'rows': 0, 'unique': 0}
+        self.protein_cache = encoded_protein_cache(args)
+        self.eval()
+
+    def encode_graphs(self, mol_batch):
+        return self.molecule_stage(*encoder_inputs(mol_batch, self.args, self.args.cuda))
+
+    def project_proteins(self, batch_prot):
+        prot_node_feat = self.protein_stage(batch_prot.x, batch_prot.edge_index.long())
+        prot_node_feat, prot_mask, prot_graph_feat = graph_readout(prot_node_feat, batch_prot.batch,
+                                                                   batch_prot.num_graphs)
+        return prot_graph_feat, self.project_keys(prot_node_feat), prot_mask
+
+    def project_keys(self, prot_node_feat):
+        return tuple(self.keys_stage(prot_node_feat))
+
+    def forward(self, smiles, batch_prot):
+        mol_feat, atom_feat, atom_mask = encode_molecules(self, smiles, self.encode_graphs)
+        prot_graph_feat, projected_keys, prot_mask = self.encode_proteins(batch_prot)
+        # the head takes one protein per row
+        (keys, values), prot_mask = gather_keys(projected_keys, prot_mask, batch_prot.row_index)
+        prot_graph_feat = prot_graph_feat[batch_prot.row_index]
+        output = self.head_stage(mol_feat, atom_feat, atom_mask, prot_graph_feat, keys, values, prot_mask)
+        return [output, None, None, None], [None, None], prot_graph_feat, [None, None]
+
+
+def compiled_path(args):
+    return os.path.join(args.model_path, 'compiled')
+
+
+def onnx_path(args):
+    return os.path.join(args.model_path, 'onnx')
+
+
+def compiled_meta(args):
+    # the compiled stages are only valid for the checkpoint and the arguments they were traced with,
+    # legacy_attn_mask selects the masking of the traced head
+    return {'checkpoint_mtime': os.path.getmtime(args.save_best_model_path), 'stages': STAGES,
+            'molecule_inputs': list(ONNX_INPUTS['molecule']),
+            'num_heads': args.num_heads, 'atom_messages': args.atom_messages, 'step': args.step,
+            'legacy_attn_mask': args.legacy_attn_mask}
+
+
+def stage_examples(args, model, stages, prot_graph_dict, smiles, prot_ids):
+    """
+    Runs the stages on the first two batches of smiles/prot_ids.
+
+    :return: For every batch, a dict of the inputs of every stage.
+    """
+    examples = []
+    for i in range(0, min(len(smiles), 2 * args.batch_size), args.batch_size):
+        molecules, mol_row_index = unique_molecules(smiles[i:i + args.batch_size])
+        mol_batch = mol2graph(molecules, args, False)
+        mol_batch.row_index = mol_row_index
+        batch_prot = ProteinBatch.from_ids(prot_graph_dict, prot_ids[i:i + args.batch_size]).to(args.device)
+        with torch.no_grad():
+            molecule_inputs = encoder_inputs(mol_batch, args, args.cuda)
+            mol_feat, atom_feat, atom_mask = stages['molecule'](*[x.clone() for x in molecule_inputs])
+            protein_inputs = (batch_prot.graphs.x, batch_prot.graphs.edge_index.long())
+            prot_node_feat, prot_mask, prot_graph_feat = model.protein_encoder(batch_prot.graphs)
+            keys, values = model.project_keys(prot_node_feat)
+        # the head takes one molecule and protein per row, any pairing serves as an example
+        row_index = batch_prot.row_index[:len(mol_feat)]
+        examples.append({'molecule': molecule_inputs, 'protein': protein_inputs, 'keys': (prot_node_feat,),
+                         'head': (mol_feat[:len(row_index)], atom_feat[:len(row_index)], atom_mask[:len(row_index)],
+                                  prot_graph_feat[row_index], keys[row_index], values[row_index],
+                                  prot_mask[row_index])})
+    return examples
+
+
+def build_stages(model):
+    if type(model) is not KANO_Prot:
+        raise ValueError(f'only KANO_Prot can be compiled or exported, not {type(model).__name__}')
+    model.eval()
+    # in eval mode too, since exporting a stage leaves the modules it shares with model in the mode of the stage
+    stages = {'molecule': MoleculeStage(model), 'protein': ProteinStage(model), 'keys': KeysStage(model),
+              'head': HeadStage(model)}
+    return {name: stage.eval() for name, stage in stages.items()}
+
+
+def compile_model(args, model, prot_graph_dict, smiles, prot_ids):
+    """
+    Traces the molecule, protein, keys and head stages of a trained KANO_Prot with TorchScript and saves them
+    in <model_path>/compiled.
+
+    The stages are traced on the first batch of smiles/prot_ids and checked against the second one.
+
+    :param model: A KANO_Prot with the weights of args.save_best_model_path.
+    :param smiles: An array of SMILES strings or MolGraphs to trace the stages with.
+    :param prot_ids: The protein ids paired with smiles.
+    """
+    stages = build_stages(model)
+    examples = stage_examples(args, model, stages, prot_graph_dict, smiles, prot_ids)
+    os.makedirs(compiled_path(args), exist_ok=True)
+    for name, stage in stages.items():
+        check_inputs = [tuple(x.clone() for x in example[name]) for example in examples[1:]]
+        with torch.no_grad():
+            traced = torch.jit.trace(stage, tuple(x.clone() for x in examples[0][name]),
+                                     check_inputs=check_inputs or None, check_tolerance=1e-4)
+        torch.jit.save(traced, os.path.join(compiled_path(args), f'{name}.pt'))
+    with open(os.path.join(compiled_path(args), 'meta.json'), 'w') as f:
+        json.dump(compiled_meta(args), f)
+
+
+def export_onnx(args, model, prot_graph_dict, smiles, prot_ids, scaler=None):
+    """
+    Exports the molecule, protein, keys and head stages of a trained KANO_Prot as ONNX graphs in
+    <model_path>/onnx, along with what onnx_infer.py needs to run them without torch: the functional group
+    patterns of the featurization and the label scaler.
+
+    The proteins of prot_graph_dict are also encoded once here and their residue features saved as
+    <model_path>/onnx/proteins/<prot_id>.npz, a cache from which onnx_infer.py serves them without their
+    residue embeddings. Other proteins are encoded by the protein graph.
+
+    :param model: A KANO_Prot with the weights of args.save_best_model_path.
+    :param prot_graph_dict: The protein graphs to encode, by protein id.
+    :param smiles: An array of SMILES strings or MolGraphs to export the stages with.
+    :param prot_ids: The protein ids paired with smiles.
+    :param scaler: The StandardScaler of the labels of a regression model.
+    """
+    stages = build_stages(model)
+    example = stage_examples(args, model, stages, prot_graph_dict, smiles, prot_ids)[0]
+    os.makedirs(onnx_path(args), exist_ok=True)
+    for name, stage in stages.items():
+        with torch.no_grad():
+            # the TorchScript-based exporter, since the sizes of the stages depend on their inputs
+            torch.onnx.utils.export(stage, tuple(x.clone() for x in example[name]),
+                                    os.path.join(onnx_path(args), f'{name}.onnx'),
+                                    input_names=list(ONNX_INPUTS[name]), output_names=list(ONNX_OUTPUTS[name]),
+                                    dynamic_axes={**ONNX_INPUTS[name], **ONNX_OUTPUTS[name]}, opset_version=17)
+
+    # the first 12 matching patterns of a molecule are embedded in its f_fgs block, see match_fg
+    np.savez(os.path.join(onnx_path(args), 'featurizer.npz'),
+             fg_smarts=np.array([fg.split()[1] for fg in funcgroups]),
+             fg_emb=np.stack([fg2emb[fg.split()[0]] for fg in funcgroups]).astype(np.float32))
+    # one protein at a time, bypassing the cache of a ProteinGraphCache so that the graphs are not kept
+    load = getattr(prot_graph_dict, 'load', prot_graph_dict.__getitem__)
+    os.makedirs(os.path.join(onnx_path(args), 'proteins'), exist_ok=True)
+    for prot_id in prot_graph_dict:
+        with torch.no_grad():
+            prot_node_feat = model.protein_encoder(Batch.from_data_list([load(prot_id)]).to(args.device))[0]
+        np.savez(os.path.join(onnx_path(args), 'proteins', f'{prot_id}.npz'),
+                 node_feat=prot_node_feat[0].float().cpu().numpy())
+    with open(os.path.join(onnx_path(args), 'meta.json'), 'w') as f:
+        json.dump({'dataset_type': args.dataset_type, 'num_heads': args.num_heads,
+                   'scaler_means': None if scaler is None else np.asarray(scaler.means, dtype=float).tolist(),
+                   'scaler_stds': None if scaler is None else np.asarray(scaler.stds, dtype=float).tolist()}, f)
+
+
+def load_compiled_model(args, logger=None):
+    """
+    Loads the stages saved by compile_model, if they are present and were traced from the current checkpoint.
+
+    :return: A CompiledKANO_Prot, or None.
+    """
+    meta_path = os.path.join(compiled_path(args), 'meta.json')
+    if args.model_path is None or not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta != compiled_meta(args):
+        logger.info(f'compiled model in {compiled_path(args)} does not match the checkpoint or arguments, '
+                    f'run --mode compile again') if logger is not None and args.print else None
+        return None
+    stages = [torch.jit.load(os.path.join(compiled_path(args), f'{name}.pt'), map_location=args.device)
+              for name in STAGES]
+    logger.info(f'load compiled model from {compiled_path(args)}') if logger is not None and args.print else None
+    return CompiledKANO_Prot(args, *stages)
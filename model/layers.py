@@ -1,7 +1,80 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from torch_geometric.data import Batch
 from torch_geometric.nn import GCNConv
+from torch_geometric.utils import to_dense_batch
+from torch_scatter import scatter_mean
+
+
+class ProteinBatch:
+    """
+    The proteins of a batch of rows, with the graph of every distinct protein batched once.
+
+    :param graphs: A Batch of the graphs of the distinct proteins.
+    :param prot_ids: The ids of the distinct proteins, in the order of graphs.
+    :param row_index: The [rows] index in graphs of the protein of every row.
+    """
+
+    def __init__(self, graphs, prot_ids, row_index):
+        self.graphs = graphs
+        self.prot_ids = prot_ids
+        self.row_index = row_index
+
+    @classmethod
+    def from_ids(cls, prot_graph_dict, prot_ids):
+        """
+        Batches the graphs of the distinct proteins of prot_ids, in order of first appearance.
+
+        :param prot_graph_dict: The protein graphs by protein id.
+        :param prot_ids: The protein id of every row.
+        """
+        position = {}
+        for prot_id in prot_ids:
+            position.setdefault(prot_id, len(position))
+        graphs = Batch.from_data_list([prot_graph_dict[prot_id] for prot_id in position])
+        row_index = torch.tensor([position[prot_id] for prot_id in prot_ids], dtype=torch.long)
+        return cls(graphs, list(position), row_index)
+
+    def __len__(self):
+        return len(self.row_index)
+
+    def to(self, device):
+        return ProteinBatch(self.graphs.to(device), self.prot_ids, self.row_index.to(device))
+
+
+def graph_readout(x, batch, num_graphs):
+    """
+    Splits the node features of a batch of graphs into a padded tensor and takes the mean of every graph.
+
+    :param x: The [num_nodes, d] node features.
+    :param batch: The graph index of every node, in increasing order.
+    :param num_graphs: The number of graphs in the batch.
+    :return: The padded [num_graphs, max_nodes, d] node features, their [num_graphs, max_nodes] mask
+             and the [num_graphs, d] graph means.
+    """
+    node_feat, node_mask = to_dense_batch(x, batch, batch_size=num_graphs)
+    graph_feat = scatter_mean(x, batch, dim=0, dim_size=num_graphs)
+    return node_feat, node_mask, graph_feat
+
+
+def gather_keys(projected_keys, key_mask, key_index):
+    """
+    Gathers the per-head keys and values and the key mask of the distinct proteins of a batch for every row.
+
+    The keys of a batch of a single protein are expanded to the rows without copying them.
+
+    :param projected_keys: The [proteins, num_heads, max_m, d_k] keys and values.
+    :param key_mask: The [proteins, max_m] key mask.
+    :param key_index: The [rows] index of the protein of every row.
+    :return: The [rows, num_heads, max_m, d_k] keys and values and the [rows, max_m] key mask.
+    """
+    keys, values = projected_keys
+    if keys.size(0) == 1:
+        rows = len(key_index)
+        return (keys.expand(rows, -1, -1, -1), values.expand(rows, -1, -1, -1)), key_mask.expand(rows, -1)
+    return (keys[key_index], values[key_index]), key_mask[key_index]
 
 
 class ProteinEncoder(nn.Module):
@@ -17,26 +90,39 @@ class ProteinEncoder(nn.Module):
         self.drop1 = nn.Dropout(p=self.args.dropout) #dp 0.2
 
     def forward(self, data, pertubed=False):
-        x = data.x
+        """
+        Encodes a Batch of protein graphs, or the distinct proteins of a ProteinBatch.
+
+        :return: The padded [num_graphs, max_nodes, 300] residue features, their mask and the graph means.
+        """
+        if isinstance(data, ProteinBatch):
+            data = data.graphs
+        x = self.encode_nodes(data.x, data.edge_index.long(), pertubed)
+        # data.x is left untouched so that the batch can be encoded again
+        return graph_readout(x, data.batch, data.num_graphs)
+
+    def encode_nodes(self, x, edge_index, pertubed=False):
         x = self.drop1(x)
         for idx, gcn_layer in enumerate(self.gcn):
-            x = F.relu(gcn_layer(x, data.edge_index.long()))
+            x = F.relu(gcn_layer(x, edge_index))
             if pertubed:
                 random_noise = torch.rand_like(x).to(x.device)
                 x = x + torch.sign(x) * F.normalize(random_noise, dim=-1) * 0.1
-        data.x = x
-        num_graphs = data.num_graphs
-        node_embeddings_list = []
-        graph_embeddings_list = []
-        for i in range(num_graphs):
-            mask = data.batch == i
-            graph_embeddings = data.x[mask]
-            node_embeddings_list.append(graph_embeddings)
-            graph_embeddings_list.append(torch.mean(graph_embeddings, dim=0))
-        graph_embeddings_list = torch.stack(graph_embeddings_list, dim=0)
-        return node_embeddings_list, graph_embeddings_list
+        return x
     
 
+def pad_tensors(tensor_list):
+    """
+    Pads a list of [n_i, d] tensors to a [batch, max_n, d] tensor.
+
+    :return: The padded tensor and a [batch, max_n] boolean mask of its real rows.
+    """
+    lengths = torch.tensor([t.size(0) for t in tensor_list], device=tensor_list[0].device)
+    padded = pad_sequence(tensor_list, batch_first=True)
+    mask = torch.arange(padded.size(1), device=padded.device) < lengths.unsqueeze(1)
+    return padded, mask
+
+
 class FeedForwardNetwork(nn.Module):
     def __init__(self, hidden_size, ffn_size):
         super(FeedForwardNetwork, self).__init__()
@@ -143,7 +229,7 @@ class FeedForwardNetwork(nn.Module):
 #         return torch.stack(pooled_outputs, axis=0), attention
 
 class MultiHeadCrossAttentionPooling(nn.Module):
-    def __init__(self, d_model, num_heads, dropout_rate=0.05, pooling='mean'):
+    def __init__(self, d_model, num_heads, dropout_rate=0.05, pooling='mean', legacy_mask=False):
         # dp 0.1
         super(MultiHeadCrossAttentionPooling, self).__init__()
         self.d_model = d_model
@@ -160,65 +246,92 @@ class MultiHeadCrossAttentionPooling(nn.Module):
         self.out_linear = FeedForwardNetwork(d_model, d_model)
         self.self_attention_dropout = nn.Dropout(dropout_rate)
         self.pooling = pooling
-
-    def forward(self, query_list, key_list):
-        # initialize padding tensors
-        max_n = max([q.size(0) for q in query_list])
-        max_m = max([k.size(0) for k in key_list])
-        
-        padded_queries = torch.zeros((len(query_list), max_n, self.d_model)).to(query_list[0].device)
-        padded_keys = torch.zeros((len(key_list), max_m, self.d_model)).to(query_list[0].device)
-        query_masks = torch.zeros(len(query_list), max_n, dtype=torch.bool).to(query_list[0].device)
-        key_masks = torch.zeros(len(key_list), max_m, dtype=torch.bool).to(query_list[0].device)
-        
-        for i, (q, k) in enumerate(zip(query_list, key_list)):
-            padded_queries[i, :q.size(0), :] = q
-            padded_keys[i, :k.size(0), :] = k
-            query_masks[i, :q.size(0)] = True
-            key_masks[i, :k.size(0)] = True
+        self.legacy_mask = legacy_mask
+
+    def project_keys(self, keys):
+        """
+        Projects padded [batch, max_m, d_model] keys to the per-head [batch, num_heads, max_m, d_k] keys and values.
+        """
+        batch_size, max_m = keys.size(0), keys.size(1)
+        keys_transformed = self.key_linear(keys).view(batch_size, max_m, self.num_heads, self.d_k)
+        values_transformed = self.value_linear(keys).view(batch_size, max_m, self.num_heads, self.d_k)
+        return keys_transformed.transpose(1, 2), values_transformed.transpose(1, 2)
+
+    def forward(self, query_list, key_list, query_mask=None, key_mask=None, return_attention=True,
+                projected_keys=None, key_index=None):
+        """
+        Attends the queries (atoms) of every pair to its keys (residues) and pools the attended queries.
+
+        :param query_list: A list of [n_i, d_model] query tensors, or a padded [batch, max_n, d_model]
+                           tensor if query_mask is given.
+        :param key_list: A list of [m_i, d_model] key tensors, or a padded [batch, max_m, d_model]
+                         tensor if key_mask is given.
+        :param query_mask: A [batch, max_n] boolean mask of the real rows of a padded query_list.
+        :param key_mask: A [batch, max_m] boolean mask of the real rows of a padded key_list.
+        :param return_attention: Whether to return the [batch, num_heads, max_n, max_m] attention weights.
+                                 Without them the fused scaled_dot_product_attention kernel is used.
+        :param projected_keys: The keys and values of key_list from project_keys, if already computed.
+                               key_list is not used then, but key_mask is required.
+        :param key_index: The index in key_list of the keys of every query, if key_list holds the keys
+                          of the distinct proteins of the batch (see ProteinBatch).
+        :return: The pooled [batch, d_model] outputs and the attention weights (or None).
+        """
+        if query_mask is None:
+            query_list, query_mask = pad_tensors(query_list)
+        if key_mask is None:
+            key_list, key_mask = pad_tensors(key_list)
+        batch_size, max_n = query_list.size(0), query_list.size(1)
 
         # padded_queries = self.self_attention_norm(padded_queries)
         # padded_keys = self.self_attention_norm(padded_keys)
         # linear transformation
-        queries_transformed = self.query_linear(padded_queries).view(len(query_list), max_n, self.num_heads, self.d_k)
-        keys_transformed = self.key_linear(padded_keys).view(len(key_list), max_m, self.num_heads, self.d_k)
-        values_transformed = self.value_linear(padded_keys).view(len(key_list), max_m, self.num_heads, self.d_k)
-
+        queries_transformed = self.query_linear(query_list).view(batch_size, max_n, self.num_heads, self.d_k)
         queries_transformed = queries_transformed.transpose(1, 2)
-        keys_transformed = keys_transformed.transpose(1, 2)
-        values_transformed = values_transformed.transpose(1, 2)
-
-        # calculate attention
-        scores = torch.matmul(queries_transformed, keys_transformed.transpose(-2, -1))
-        scores = scores / torch.sqrt(torch.tensor(self.d_k, dtype=torch.float32))
-
-        # masking
-        query_masks = query_masks.unsqueeze(1).unsqueeze(3)
-        key_masks = key_masks.unsqueeze(1).unsqueeze(2)
-        mask = query_masks & key_masks
-        scores = scores.masked_fill(~mask, float(1e-8))
-
-        # Softmax
-        attention = F.softmax(scores, dim=-1)
-        attention = self.dropout(attention)
-
-        # aggregation
-        context = torch.matmul(attention, values_transformed).transpose(1, 2).contiguous()
-        context = context.view(len(query_list), max_n, self.d_model)
+        if projected_keys is None:
+            projected_keys = self.project_keys(key_list)
+        if key_index is not None:
+            # the keys are projected once per protein and gathered for its queries
+            projected_keys, key_mask = gather_keys(projected_keys, key_mask, key_index)
+        keys_transformed, values_transformed = projected_keys
+
+        key_masks = key_mask.unsqueeze(1).unsqueeze(2)
+        if return_attention or self.legacy_mask:
+            # calculate attention
+            scores = torch.matmul(queries_transformed, keys_transformed.transpose(-2, -1))
+            scores = scores / torch.sqrt(torch.tensor(self.d_k, dtype=torch.float32))
+
+            # masking
+            if self.legacy_mask:
+                # models trained before the key mask replaced the padded scores by 1e-8 instead of -inf
+                mask = query_mask.unsqueeze(1).unsqueeze(3) & key_masks
+                scores = scores.masked_fill(~mask, float(1e-8))
+            else:
+                scores = scores.masked_fill(~key_masks, float('-inf'))
+
+            # Softmax
+            attention = F.softmax(scores, dim=-1)
+            attention = self.dropout(attention)
+
+            # aggregation
+            context = torch.matmul(attention, values_transformed)
+        else:
+            context = F.scaled_dot_product_attention(queries_transformed, keys_transformed, values_transformed,
+                                                     attn_mask=key_masks,
+                                                     dropout_p=self.dropout.p if self.training else 0.0)
+            attention = None
+        context = context.transpose(1, 2).contiguous().view(batch_size, max_n, self.d_model)
         # context = self.ffn_norm(context)
 
         output = self.out_linear(context)
         # output = self.dropout(output)
         # output = self.ffn_norm(output)
-        # remove padding
-        outputs = [output[i, :query_list[i].size(0), :] for i in range(len(query_list))]
-
-        # pooling
+        # pooling over the real rows of every query
+        pooling_masks = query_mask.unsqueeze(-1)
         if self.pooling == 'mean':
-            pooled_outputs = [torch.mean(o, dim=0) for o in outputs]
+            pooled_outputs = (output * pooling_masks).sum(1) / pooling_masks.sum(1)
         elif self.pooling == 'max':
-            pooled_outputs = [torch.max(o, dim=0)[0] for o in outputs]
+            pooled_outputs = output.masked_fill(~pooling_masks, float('-inf')).max(1)[0]
         else:
             raise ValueError("Unsupported pooling type. Use 'mean' or 'max'.")
 
-        return torch.stack(pooled_outputs, axis=0), attention
\ No newline at end of file
+        return pooled_outputs, attention if return_attention else None
\ No newline at end of file
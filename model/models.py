@@ -1,11 +1,57 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence
 from torch_geometric.data import Batch
 from KANO_model.model import MoleculeModel, prompt_generator_output
-from model.layers import ProteinEncoder, MultiHeadCrossAttentionPooling
+from KANO_model.utils import BatchMolGraph, MolGraph, mol2graph, unique_molecules
+from KANO_model.graph_cache import LRUCache
+from model.layers import ProteinEncoder, MultiHeadCrossAttentionPooling, graph_readout
 from utils import get_fingerprint, get_residue_onehot_encoding
 
 
+def encoded_protein_nbytes(entry) -> int:
+    return sum(tensor.element_size() * tensor.nelement() for tensor in entry)
+
+
+def encoded_protein_cache(args):
+    """
+    :return: An LRUCache of encoded proteins bounded by the bytes of their tensors (args.encoded_protein_cache_mb).
+    """
+    return LRUCache(int(args.encoded_protein_cache_mb * 2 ** 20), sizeof=encoded_protein_nbytes)
+
+
+def encode_molecules(model, smiles, encoder=None):
+    """
+    Encodes every distinct molecule of a batch once with the molecule encoder of model and
+    copies the features back to the rows of the batch.
+
+    The numbers of rows and of encoded molecules are added up in model.dedup_counts.
+
+    :param model: A model with args and a molecule_encoder.
+    :param smiles: A list of SMILES strings or MolGraphs, or a BatchMolGraph (with row_index if deduplicated).
+    :param encoder: A function used instead of the molecule encoder of model, taking the BatchMolGraph of
+                    the distinct molecules and returning their features, padded atom features and mask.
+    :return: The molecule features, the padded [rows, max_atoms, hidden] atom features and their mask.
+    """
+    if isinstance(smiles, BatchMolGraph):
+        mol_batch = smiles
+    else:
+        # KANO_Prot always encodes molecules with prompt=False
+        molecules, row_index = unique_molecules(smiles)
+        mol_batch = mol2graph(molecules, model.args, False)
+        mol_batch.row_index = row_index
+    row_index = mol_batch.row_index
+    if encoder is None:
+        mol_feat, atom_feat, atom_mask = model.molecule_encoder.encoder('finetune', False, mol_batch, padded=True)
+    else:
+        mol_feat, atom_feat, atom_mask = encoder(mol_batch)
+    model.dedup_counts['rows'] += len(mol_feat) if row_index is None else len(row_index)
+    model.dedup_counts['unique'] += len(mol_feat)
+    if row_index is None:
+        return mol_feat, atom_feat, atom_mask
+    return mol_feat[row_index], atom_feat[row_index], atom_mask[row_index]
+
+
 class KANO_Prot(nn.Module):
     def __init__(self, args, 
                  classification: bool, 
@@ -17,6 +63,7 @@ class KANO_Prot(nn.Module):
         :param classification: Whether the model is a classification model.
         """
         super(KANO_Prot, self).__init__()
+        self.args = args
         args.atom_output = False
         self.classification = classification
         if self.classification:
@@ -26,6 +73,7 @@ class KANO_Prot(nn.Module):
             self.multiclass_softmax = nn.Softmax(dim=2)
         assert not (self.classification and self.multiclass)
         self.multitask = multitask
+        self.dedup_counts = {'rows': 0, 'unique': 0}
         self.molecule_encoder = MoleculeModel(classification=args.dataset_type == 'classification',
                                               multiclass=args.dataset_type == 'multiclass',
                                               pretrain=False)
@@ -44,15 +92,98 @@ class KANO_Prot(nn.Module):
         self.protein_encoder = ProteinEncoder(args)
         self.cross_attn_pooling = MultiHeadCrossAttentionPooling(300, 
                                                                  num_heads=args.num_heads,
-                                                                 dropout_rate=args.dropout)
-        
+                                                                 dropout_rate=args.dropout,
+                                                                 legacy_mask=args.legacy_attn_mask)
+        # protein means, keys and values computed in eval mode, cleared whenever the weights may change
+        self.protein_cache = encoded_protein_cache(args)
+
+    def train(self, mode=True):
+        # the weights may change from here on
+        if mode:
+            self.invalidate_protein_cache()
+        return super(KANO_Prot, self).train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.invalidate_protein_cache()
+        return super(KANO_Prot, self).load_state_dict(*args, **kwargs)
+
+    def invalidate_protein_cache(self):
+        self.protein_cache.clear()
+
+    def project_proteins(self, batch_prot):
+        """
+        Encodes a Batch of proteins.
+
+        :return: The [num_proteins, hidden] protein means, the per-head keys and values of their residues
+                 and the key mask.
+        """
+        prot_node_feat, prot_mask, prot_graph_feat = self.protein_encoder(batch_prot)
+        return prot_graph_feat, self.project_keys(prot_node_feat), prot_mask
+
+    def project_keys(self, prot_node_feat):
+        """
+        Projects padded [num_proteins, max_m, hidden] residue features to the per-head keys and values.
+        """
+        return self.cross_attn_pooling.project_keys(prot_node_feat)
+
+    def encode_proteins(self, batch_prot):
+        """
+        Encodes the distinct proteins of a batch and projects their residues to the keys and values of the
+        cross-attention.
+
+        In eval mode, every protein is encoded once for the current weights and then read from
+        self.protein_cache while it is not evicted, so only the molecules of later batches are encoded.
+        The residues padding the cached proteins of a batch get the keys and values of a zero row, as in
+        the projection of a padded batch, since the legacy masking still attends to them.
+
+        :param batch_prot: A ProteinBatch.
+        :return: The [proteins, hidden] means, the per-head keys and values and the key mask of the distinct
+                 proteins, in the order of batch_prot.prot_ids.
+        """
+        if self.training:
+            return self.project_proteins(batch_prot.graphs)
+
+        # the entries of this batch, which may not all fit in the cache together
+        entries = {prot_id: self.protein_cache.get(prot_id) for prot_id in batch_prot.prot_ids}
+        missing = [j for j, prot_id in enumerate(batch_prot.prot_ids) if entries[prot_id] is None]
+        if missing:
+            batch_missing = batch_prot.graphs if len(missing) == len(batch_prot.prot_ids) \
+                            else Batch.from_data_list(batch_prot.graphs.index_select(missing))
+            projected = self.project_proteins(batch_missing)
+            prot_graph_feat, (keys, values), prot_mask = projected
+            for k, j in enumerate(missing):
+                n = int(prot_mask[k].sum())
+                # residues first, so that the proteins of a batch can be padded with pad_sequence
+                entries[batch_prot.prot_ids[j]] = (prot_graph_feat[k].detach(),
+                                                   keys[k, :, :n].transpose(0, 1).detach(),
+                                                   values[k, :, :n].transpose(0, 1).detach())
+                self.protein_cache.put(batch_prot.prot_ids[j], entries[batch_prot.prot_ids[j]])
+            if len(missing) == len(batch_prot.prot_ids):
+                return projected
+
+        cached = [entries[prot_id] for prot_id in batch_prot.prot_ids]
+        prot_graph_feat = torch.stack([graph_feat for graph_feat, _, _ in cached])
+        lengths = torch.tensor([len(keys) for _, keys, _ in cached], device=prot_graph_feat.device)
+        prot_mask = torch.arange(max(lengths).item(), device=lengths.device) < lengths.unsqueeze(1)
+        # the [1, num_heads, 1, d_k] keys and values of a zero row
+        pad_keys, pad_values = self.project_keys(prot_graph_feat.new_zeros(1, 1, prot_graph_feat.size(1)))
+        keys, values = [torch.where(prot_mask[:, :, None, None],
+                                    pad_sequence([entry[i] for entry in cached], batch_first=True),
+                                    pad[0, :, 0]).transpose(1, 2)
+                        for i, pad in [(1, pad_keys), (2, pad_values)]]
+        return prot_graph_feat, (keys, values), prot_mask
 
     def forward(self, smiles, batch_prot):
-        mol_feat, atom_feat = self.molecule_encoder.encoder('finetune', False, smiles)
-        prot_node_feat, prot_graph_feat = self.protein_encoder(batch_prot)
+        # smiles is either a list of SMILES or a BatchMolGraph featurized ahead of time
+        mol_feat, atom_feat, atom_mask = encode_molecules(self, smiles)
+        prot_graph_feat, prot_keys, prot_mask = self.encode_proteins(batch_prot)
         # mol_feat = torch.concat([mol_feat, prot_graph_feat], dim=1)
         # mol_attn = None
-        cmb_feat, mol_attn = self.cross_attn_pooling(atom_feat, prot_node_feat)
+        # the attention weights are only kept for inspection, training uses the fused kernel
+        cmb_feat, mol_attn = self.cross_attn_pooling(atom_feat, None, atom_mask, prot_mask,
+                                                     return_attention=not self.training,
+                                                     projected_keys=prot_keys, key_index=batch_prot.row_index)
+        prot_graph_feat = prot_graph_feat[batch_prot.row_index]
         mol_feat = torch.concat([mol_feat, prot_graph_feat, cmb_feat], dim=1)
         output = self.molecule_encoder.ffn(mol_feat)
         return [output, None, None, None], [mol_feat, None], prot_graph_feat, [mol_attn, None]
@@ -80,6 +211,7 @@ class KANO_Prot_ablation(nn.Module):
             self.multiclass_softmax = nn.Softmax(dim=2)
         assert not (self.classification and self.multiclass)
         self.multitask = multitask
+        self.dedup_counts = {'rows': 0, 'unique': 0}
         self.molecule_encoder = MoleculeModel(classification=args.dataset_type == 'classification',
                                                 multiclass=args.dataset_type == 'multiclass',
                                                 pretrain=False)
@@ -103,7 +235,8 @@ class KANO_Prot_ablation(nn.Module):
         # cross attention pooling
         if self.ablation in ['Attn', 'KANO']:
             self.cross_attn_pooling = None
-        self.cross_attn_pooling = MultiHeadCrossAttentionPooling(300, args.num_heads)
+        self.cross_attn_pooling = MultiHeadCrossAttentionPooling(300, args.num_heads,
+                                                                 legacy_mask=args.legacy_attn_mask)
         
         # concatenate
         if self.ablation in ['Attn', 'KANO']:
@@ -117,27 +250,36 @@ class KANO_Prot_ablation(nn.Module):
 
     def forward(self, smiles, batch_prot):
         if self.ablation == 'KANO':
+            if isinstance(smiles, BatchMolGraph):
+                smiles = smiles.smiles_batch if smiles.row_index is None \
+                         else [smiles.smiles_batch[i] for i in smiles.row_index]
+            elif isinstance(smiles[0], MolGraph):
+                smiles = [mol_graph.smiles for mol_graph in smiles]
             mol_feat = torch.tensor(get_fingerprint(smiles)).float().to(self.args.device)
             mol_feat = self.molecule_encoder1(mol_feat)
-            atom_feat = None
+            atom_feat = atom_mask = None
         else:
-            mol_feat, atom_feat = self.molecule_encoder.encoder('finetune', False, smiles)
+            mol_feat, atom_feat, atom_mask = encode_molecules(self, smiles)
 
+        # the distinct proteins of the batch are encoded, and gathered for every row
+        graphs = batch_prot.graphs
         if self.ablation == 'GCN':
-            prot_x = batch_prot.x
+            prot_x = graphs.x
             prot_node_feat = self.protein_encoder(prot_x)
-            prot_node_feat = [prot_node_feat[batch_prot.ptr[i]: batch_prot.ptr[i+1]] 
-                                                for i in range(len(batch_prot.ptr)-1)]
-            prot_graph_feat = torch.stack([torch.mean(prot, dim=0) for prot in prot_node_feat], dim=0)
+            prot_node_feat, prot_mask, prot_graph_feat = graph_readout(prot_node_feat, graphs.batch,
+                                                                       graphs.num_graphs)
         elif self.ablation == 'ESM':
-            batch_prot = get_residue_onehot_encoding(self.args, batch_prot)
-            prot_node_feat, prot_graph_feat = self.protein_encoder(batch_prot)
+            graphs = get_residue_onehot_encoding(self.args, graphs)
+            prot_node_feat, prot_mask, prot_graph_feat = self.protein_encoder(graphs)
         else:
-            prot_node_feat, prot_graph_feat = self.protein_encoder(batch_prot)
+            prot_node_feat, prot_mask, prot_graph_feat = self.protein_encoder(graphs)
         if self.ablation in ['KANO', 'Attn']:
+            prot_graph_feat = prot_graph_feat[batch_prot.row_index]
             mol_feat = torch.concat([mol_feat, prot_graph_feat], dim=1)
         else:
-            cmb_feat, mol_attn = self.cross_attn_pooling(atom_feat, prot_node_feat)
+            cmb_feat, _ = self.cross_attn_pooling(atom_feat, prot_node_feat, atom_mask, prot_mask,
+                                                  return_attention=False, key_index=batch_prot.row_index)
+            prot_graph_feat = prot_graph_feat[batch_prot.row_index]
             mol_feat = torch.concat([mol_feat, prot_graph_feat, cmb_feat], dim=1)
         output = self.molecule_encoder.ffn(mol_feat)
         return [output, None, None, None], [mol_feat, None], prot_graph_feat, [None, None]
@@ -154,6 +296,7 @@ class KANO_ESM(nn.Module):
         :param classification: Whether the model is a classification model.
         """
         super(KANO_ESM, self).__init__()
+        self.args = args
         args.atom_output = False
         self.classification = classification
         if self.classification:
@@ -163,6 +306,7 @@ class KANO_ESM(nn.Module):
             self.multiclass_softmax = nn.Softmax(dim=2)
         assert not (self.classification and self.multiclass)
         self.multitask = multitask
+        self.dedup_counts = {'rows': 0, 'unique': 0}
         self.molecule_encoder = MoleculeModel(classification=args.dataset_type == 'classification',
                                               multiclass=args.dataset_type == 'multiclass',
                                               pretrain=False)
@@ -179,12 +323,11 @@ class KANO_ESM(nn.Module):
         
 
     def forward(self, smiles, batch_prot):
-        mol_feat, atom_feat = self.molecule_encoder.encoder('finetune', False, smiles)
-        prot_x = batch_prot.x
+        mol_feat, _, _ = encode_molecules(self, smiles)
+        prot_x = batch_prot.graphs.x
         prot_node_feat = self.protein_encoder(prot_x)
-        prot_node_feat = [prot_node_feat[batch_prot.ptr[i]: batch_prot.ptr[i+1]] 
-                                            for i in range(len(batch_prot.ptr)-1)]
-        prot_graph_feat = torch.stack([torch.mean(prot, dim=0) for prot in prot_node_feat], dim=0)
+        _, _, prot_graph_feat = graph_readout(prot_node_feat, batch_prot.graphs.batch, batch_prot.graphs.num_graphs)
+        prot_graph_feat = prot_graph_feat[batch_prot.row_index]
         cpi_feat = torch.concat([mol_feat, prot_graph_feat], dim=1)
         output = self.molecule_encoder.ffn(cpi_feat)
         return [output, None, None, None], [mol_feat, None], prot_graph_feat, [None, None]
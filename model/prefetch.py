@@ -0,0 +1,112 @@
+import torch
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
+
+import KANO_model.utils as kano_utils
+from KANO_model.utils import mol2graph, unique_molecules
+from model.layers import ProteinBatch
+
+# state of a prefetch worker, set once by _init_worker
+_WORKER_ARGS = None
+# the process pool of the main process, shared by the epochs of the same settings
+PREFETCHER = None
+# the arguments read by the prefetcher and its workers, a pool is only reused while they are unchanged
+PREFETCH_ARGS = ['num_workers', 'prefetch', 'baseline_model', 'atom_messages', 'feature_encoding',
+                 'no_cache', 'graph_cache_path', 'graph_cache_size']
+
+
+def _flush_graph_store():
+    if kano_utils.GRAPH_STORE is not None:
+        kano_utils.GRAPH_STORE.flush()
+
+
+def _init_worker(args, hrc2emb):
+    global _WORKER_ARGS
+    _WORKER_ARGS = args
+    # the KANO embeddings of the main process, which are drawn at random on import
+    kano_utils.hrc2emb = hrc2emb
+    # the workers run side by side with the model, keep them from oversubscribing the cores
+    torch.set_num_threads(1)
+    # atexit does not run in pool workers, so write out the graphs featurized here on shutdown
+    Finalize(None, _flush_graph_store, exitpriority=10)
+
+
+def _featurize_batch(bound, smiles):
+    # KANO_Prot always encodes molecules with prompt=False
+    molecules, row_index = unique_molecules(smiles)
+    mol_batch = mol2graph(molecules, _WORKER_ARGS, False)
+    mol_batch.row_index = row_index
+    return bound, mol_batch
+
+
+def prefetch_key(args):
+    return tuple(getattr(args, name, None) for name in PREFETCH_ARGS)
+
+
+class BatchPrefetcher:
+    """
+    Featurizes the molecules of batches of compound-protein pairs in a pool of worker processes.
+
+    The workers are started by a fork server rather than forked from the main process, whose torch
+    thread pools may already be running, and receive args and the KANO embeddings in their initializer.
+    The protein graphs of the batches are gathered in the main process.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.key = prefetch_key(args)
+        # graphs featurized by the main process are then found in the store by the workers
+        _flush_graph_store()
+        self.pool = ProcessPoolExecutor(max_workers=args.num_workers,
+                                        mp_context=mp.get_context('forkserver'),
+                                        initializer=_init_worker,
+                                        initargs=(args, kano_utils.hrc2emb))
+
+    def iterate(self, prot_graph_dict, smiles, data_prot, bounds):
+        """
+        Yields the featurized batches of bounds in order, keeping args.prefetch batches in flight.
+
+        :param prot_graph_dict: A mapping from protein id to protein graph.
+        :param smiles: An array of SMILES strings.
+        :param data_prot: An array of protein ids paired with smiles.
+        :param bounds: The (start, end) indices of the batches.
+        :return: A generator of ((start, end), BatchMolGraph, ProteinBatch).
+        """
+        bounds = iter(bounds)
+        futures = deque()
+        while True:
+            while len(futures) < self.args.prefetch:
+                bound = next(bounds, None)
+                if bound is None:
+                    break
+                futures.append(self.pool.submit(_featurize_batch, bound, list(smiles[bound[0]:bound[1]])))
+            if not futures:
+                return
+            (i, j), mol_batch = futures.popleft().result()
+            yield (i, j), mol_batch, ProteinBatch.from_ids(prot_graph_dict, data_prot[i:j])
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+def prefetch_batches(args, prot_graph_dict, smiles, data_prot, bounds):
+    """
+    Yields the batches of an epoch, their molecules featurized args.prefetch steps ahead by args.num_workers processes.
+
+    With num_workers=0 the molecules are left as SMILES and featurized by the model as before.
+
+    :param bounds: The (start, end) indices of the batches.
+    :return: A generator of ((start, end), SMILES or BatchMolGraph, ProteinBatch).
+    """
+    global PREFETCHER
+    if args.num_workers == 0:
+        for i, j in bounds:
+            yield (i, j), smiles[i:j], ProteinBatch.from_ids(prot_graph_dict, data_prot[i:j])
+        return
+    if PREFETCHER is None or PREFETCHER.key != prefetch_key(args):
+        if PREFETCHER is not None:
+            PREFETCHER.shutdown()
+        PREFETCHER = BatchPrefetcher(args)
+    yield from PREFETCHER.iterate(prot_graph_dict, smiles, data_prot, bounds)
@@ -0,0 +1,87 @@
+import os
+import copy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+
+# the submodules of KANO_Prot quantized to int8: the CMPN encoder with its prompt generator,
+# the feed-forward head and the cross-attention pooling, but not the protein GCN
+QUANTIZED_PREFIXES = ('molecule_encoder.encoder.', 'molecule_encoder.ffn.', 'cross_attn_pooling.')
+
+
+def quantized_path(args):
+    return args.save_best_model_path.replace('.pt', '_int8.pt')
+
+
+def quantized_modules(model, quantize_gru=False):
+    """
+    Lists the names of the submodules of a model to quantize.
+
+    :param quantize_gru: Whether to quantize the GRU of BatchGRU along with the linear layers.
+    :return: A sorted list of module names.
+    """
+    types = (nn.Linear, nn.GRU) if quantize_gru else (nn.Linear,)
+    return sorted(name for name, module in model.named_modules()
+                  if name.startswith(QUANTIZED_PREFIXES) and type(module) in types)
+
+
+def quantize_model(model, modules):
+    """
+    Returns an int8 copy of a model for CPU inference, with the weights of modules quantized
+    and their activations quantized on the fly.
+    """
+    if not modules:
+        raise ValueError(f'{type(model).__name__} has no layers to quantize')
+    model = quantize_dynamic(copy.deepcopy(model).cpu().eval(),
+                             {name: default_dynamic_qconfig for name in modules}, dtype=torch.qint8, inplace=True)
+    if hasattr(model, 'invalidate_protein_cache'):
+        model.invalidate_protein_cache()
+    return model
+
+
+def quantized_is_current(args):
+    """
+    Returns whether the int8 model of args.save_best_model_path exists and was quantized from its current weights.
+    """
+    if not os.path.exists(quantized_path(args)):
+        return False
+    state = torch.load(quantized_path(args), map_location='cpu', weights_only=False)
+    return state['checkpoint_mtime'] == os.path.getmtime(args.save_best_model_path)
+
+
+def save_quantized_model(args, model, logger=None):
+    """
+    Quantizes a trained model and saves it next to its checkpoint as <name>_int8.pt.
+
+    :param model: A KANO_Prot with the weights of args.save_best_model_path.
+    :return: The quantized model.
+    """
+    modules = quantized_modules(model, args.quantize_gru)
+    model = quantize_model(model, modules)
+    torch.save({'state_dict': model.state_dict(), 'modules': modules,
+                'checkpoint_mtime': os.path.getmtime(args.save_best_model_path)}, quantized_path(args))
+    logger.info(f'quantized {len(modules)} modules to int8, saved in {quantized_path(args)}') \
+        if logger is not None and args.print else None
+    return model
+
+
+def load_quantized_model(args, model, logger=None):
+    """
+    Loads the checkpoint saved by save_quantized_model into an int8 copy of model.
+
+    :param model: A KANO_Prot with the architecture of the quantized checkpoint.
+    :return: The quantized model.
+    """
+    if args.cuda:
+        raise ValueError('the int8 model only runs on CPU, use --no_cuda')
+    if not os.path.exists(quantized_path(args)):
+        raise FileNotFoundError(f'{quantized_path(args)} not found, run --mode quantize first')
+    # the packed weights of a quantized GRU are pickled as ScriptObjects
+    state = torch.load(quantized_path(args), map_location='cpu', weights_only=False)
+    if state['checkpoint_mtime'] != os.path.getmtime(args.save_best_model_path):
+        raise ValueError(f'{quantized_path(args)} was quantized from older weights than '
+                         f'{args.save_best_model_path}, run --mode quantize again')
+    model = quantize_model(model, state['modules'])
+    model.load_state_dict(state['state_dict'])
+    logger.info(f'load int8 model from {quantized_path(args)}') if logger is not None and args.print else None
+    return model
@@ -9,7 +9,18 @@ from chemprop.train.evaluate import evaluate_predictions
 from torch_geometric.data import Batch
 from torch.optim.lr_scheduler import ExponentialLR
 from sklearn.metrics import roc_auc_score, average_precision_score
-from model.utils import generate_siamse_smi
+from model.utils import generate_siamse_smi, protein_grouped_batches
+from model.prefetch import prefetch_batches
+
+
+def autocast(args):
+    """
+    Returns the autocast context of args.precision for the forward pass (and loss) of the model.
+
+    bfloat16 has the exponent range of float32, so its gradients need no loss scaling.
+    """
+    return torch.autocast(device_type=args.device.type, dtype=torch.bfloat16,
+                          enabled=args.precision == 'bf16')
 
 
 def retrain_scheduler(args, data, optimizer, scheduler, n_iter):
@@ -32,18 +43,19 @@ def predict_epoch(args, model, prot_graph_dict, data, data_prot, siams_data, sca
     # iter_size = 256 if 256 < len(query_smiles) else len(query_smiles)
     iter_size = args.batch_size
 
-    for i in tqdm(range(0, len(query_smiles), iter_size)):
-        smiles = query_smiles[i:i + iter_size]
-        prot_ids = data_prot[i:i + iter_size]
-        batch_prot = Batch.from_data_list([prot_graph_dict[prot_id] for prot_id in prot_ids]).to(args.device)
+    bounds = [(i, i + iter_size) for i in range(0, len(query_smiles), iter_size)]
+    for _, mol_batch, batch_prot in tqdm(prefetch_batches(args, prot_graph_dict, query_smiles, data_prot, bounds),
+                                         total=len(bounds)):
+        batch_prot = batch_prot.to(args.device)
 
-        with torch.no_grad():
-            batch_pred, mol1, prot, mol_attn = model(smiles, batch_prot)
+        with torch.no_grad(), autocast(args):
+            # KANO_Prot encodes every protein once per evaluation pass, keyed by its id
+            batch_pred, mol1, prot, mol_attn = model(mol_batch, batch_prot)
 
         if args.dataset_type == 'classification':
-            batch_pred = torch.sigmoid(batch_pred[0]).cpu().numpy().flatten()
+            batch_pred = torch.sigmoid(batch_pred[0]).float().cpu().numpy().flatten()
         else:
-            batch_pred = batch_pred[0].cpu().numpy().flatten()
+            batch_pred = batch_pred[0].float().cpu().numpy().flatten()
 
         if scaler:
             batch_pred = scaler.inverse_transform(batch_pred)
@@ -58,12 +70,23 @@ def predict_epoch(args, model, prot_graph_dict, data, data_prot, siams_data, sca
 
 
 def train_epoch(args, model, prot_graph_dict, data, data_prot, siams_data, 
-                loss_func, optimizer, scheduler, n_iter):
+                loss_func, optimizer, scheduler, n_iter, epoch=0):
     model.train()
+    # model.dedup_counts then counts the molecules of this epoch only
+    model.dedup_counts = {'rows': 0, 'unique': 0}
     query_smiles, query_labels = data
-    data_idx = list(range(len(query_smiles)))
-    random.seed(0)
-    random.shuffle(data_idx)
+    if args.batch_sampler == 'protein':
+        # a few proteins per batch, each encoded once for all its rows, in a new order every epoch
+        batches = protein_grouped_batches(data_prot, args.batch_size, args.proteins_per_batch, args.seed + epoch)
+        data_idx = np.concatenate(batches)
+        ends = np.cumsum([len(batch) for batch in batches])
+        bounds = list(zip([0] + ends[:-1].tolist(), ends.tolist()))
+    else:
+        data_idx = list(range(len(query_smiles)))
+        random.seed(0)
+        random.shuffle(data_idx)
+        bounds = [(i, i + args.batch_size) for i in range(0, len(query_smiles), args.batch_size)
+                  if i + args.batch_size <= len(query_smiles)]
 
     query_smiles, query_labels = query_smiles[data_idx], torch.tensor(query_labels[data_idx]).float().to(args.device)
     data_prot = data_prot[data_idx]
@@ -79,20 +102,19 @@ def train_epoch(args, model, prot_graph_dict, data, data_prot, siams_data,
     # catch up the scheduler to the current iteration
     pred_all, label_all = [], []
     loss_all = [0, 0, 0, 0] if args.dataset_type == 'regression' else [0]
-    for i in tqdm(range(0, len(query_smiles), iter_size)):
-        if i + iter_size > len(query_smiles):
-            break
-        prot_ids = data_prot[i:i + iter_size]
-        batch_prot = Batch.from_data_list([prot_graph_dict[prot_id] for prot_id in prot_ids]).to(args.device)
-        smiles, label = query_smiles[i:i + iter_size], query_labels[i:i + iter_size]
-        reg_label_ = reg_label[i:i + iter_size]
+    for (i, j), mol_batch, batch_prot in tqdm(prefetch_batches(args, prot_graph_dict, query_smiles, data_prot, bounds),
+                                              total=len(bounds)):
+        batch_prot = batch_prot.to(args.device)
+        smiles, label = query_smiles[i:j], query_labels[i:j]
+        reg_label_ = reg_label[i:j]
         if len(set(label)) == 1:
             logger.info(f'All labels are the same: {label}, skip the iteration!')
             continue
         model.zero_grad()
 
-        pred, mol1, prot, mol_attn = model(smiles, batch_prot)
-        loss = loss_func(pred, [mol1, None], [None, None], [reg_label_, None, None], None)
+        with autocast(args):
+            pred, mol1, prot, mol_attn = model(mol_batch, batch_prot)
+            loss = loss_func(pred, [mol1, None], [None, None], [reg_label_, None, None], None)
 
         iter_count += 1
         if args.dataset_type == 'regression':
@@ -101,7 +123,7 @@ def train_epoch(args, model, prot_graph_dict, data, data_prot, siams_data,
         elif args.dataset_type == 'classification':
             loss_all = [loss_all[0] + loss[0].item()]
             pred = torch.sigmoid(pred[0])
-            pred_all.extend(pred.detach().cpu().numpy().flatten().tolist())
+            pred_all.extend(pred.detach().float().cpu().numpy().flatten().tolist())
             label_all.extend(label.detach().cpu().numpy().flatten().tolist())
         loss[0].backward()
         optimizer.step()
@@ -24,8 +24,24 @@ from KANO_model.model import add_functional_prompt
 from KANO_model.utils import build_optimizer, build_lr_scheduler, build_loss_func
 
 
+def load_attn_mask(args, model, state, logger):
+    """
+    Masks the cross-attention of a model the way its checkpoint was trained, recorded in the saved args.
+    Checkpoints saved before --legacy_attn_mask existed were trained with the legacy masking.
+
+    :param state: The checkpoint written by save_checkpoint.
+    """
+    legacy_mask = getattr(state.get('args'), 'legacy_attn_mask', True)
+    if legacy_mask != args.legacy_attn_mask:
+        logger.info(f'the checkpoint was trained {"with" if legacy_mask else "without"} --legacy_attn_mask, '
+                    f'masking the cross-attention accordingly') if args.print else None
+    args.legacy_attn_mask = legacy_mask
+    if getattr(model, 'cross_attn_pooling', None) is not None:
+        model.cross_attn_pooling.legacy_mask = legacy_mask
+
+
 def set_up_model(args, logger):
-    assert args.mode in ['train', 'retrain', 'finetune', 'inference', 'baseline_inference']
+    assert args.mode in ['train', 'retrain', 'finetune', 'inference', 'baseline_inference', 'compile', 'quantize', 'export_onnx']
     if args.ablation == 'none':
         if args.train_model == 'KANO_Prot':
             model = KANO_Prot(args,
@@ -64,8 +80,9 @@ def set_up_model(args, logger):
     args.previous_epoch = 0
     
     if args.mode == 'finetune':
-        model.load_state_dict(torch.load(os.path.join(args.model_path,
-                                        f'{args.train_model}_best_model.pt'), map_location='cpu')['state_dict'])
+        state = torch.load(os.path.join(args.model_path, f'{args.train_model}_best_model.pt'), map_location='cpu')
+        model.load_state_dict(state['state_dict'])
+        load_attn_mask(args, model, state, logger)
         logger.info(f'load model from {args.model_path} for finetuning') if args.print else None
     elif args.mode == 'retrain':
         try:
@@ -73,15 +90,18 @@ def set_up_model(args, logger):
         except:
             pre_file = torch.load(args.save_model_path.split('.')[0] + '_ft.pt', map_location='cpu')
         model.load_state_dict(pre_file['state_dict'])
+        load_attn_mask(args, model, pre_file, logger)
         logger.info(f'load model from {args.save_model_path} for retraining') if args.print else None
         optimizer.load_state_dict(pre_file['optimizer'])
         logger.info(f'optimizer: {optimizer}') if args.print else None
         logger.info(f'load optimizer from {args.save_model_path} for retraining') if args.print else None
         args.previous_epoch = pre_file['epoch']
         logger.info(f'retrain from epoch {args.previous_epoch}, { args.epochs - args.previous_epoch} lasting') if args.print else None
-    elif args.mode in ['inference', 'baseline_infernce']:
+    elif args.mode in ['inference', 'baseline_infernce', 'compile', 'quantize', 'export_onnx']:
         model.cpu()
-        model.load_state_dict(torch.load(args.save_best_model_path, map_location='cpu')['state_dict'])
+        state = torch.load(args.save_best_model_path, map_location='cpu')
+        model.load_state_dict(state['state_dict'])
+        load_attn_mask(args, model, state, logger)
         model.to(args.device)
         logger.info(f'load model from {args.save_best_model_path} for inference') if args.print else None
     
@@ -130,6 +150,40 @@ def generate_siamse_smi(data, query_prot_ids,
     return [np.array(smiles), np.array(label)], [np.array(siam_smiles), np.array(siam_label)]
 
 
+def protein_grouped_batches(data_prot, batch_size, proteins_per_batch, seed=0):
+    """
+    Groups the training rows into batches of at most batch_size rows and proteins_per_batch proteins.
+
+    The rows of every protein are shuffled and cut into chunks of batch_size // proteins_per_batch rows,
+    the chunks of all proteins are shuffled and packed in that order into batches of whole chunks, so every
+    seed gives a different order and different batches. Proteins whose rows do not fill their last chunk
+    leave some batches short of batch_size.
+
+    :param data_prot: The protein id of every row.
+    :param seed: The random seed, e.g. the seed of the run plus the epoch.
+    :return: A list of arrays of row indices, one per batch.
+    """
+    rng = np.random.default_rng(seed)
+    chunk_size = max(batch_size // proteins_per_batch, 1)
+    _, inverse = np.unique(np.asarray(data_prot), return_inverse=True)
+    rows_by_prot = np.split(np.argsort(inverse, kind='stable'), np.cumsum(np.bincount(inverse))[:-1])
+    chunks = []
+    for rows in rows_by_prot:
+        rows = rng.permutation(rows)
+        chunks.extend(np.split(rows, range(chunk_size, len(rows), chunk_size)))
+
+    batches, batch, batch_rows = [], [], 0
+    for j in rng.permutation(len(chunks)):
+        if batch and (len(batch) == proteins_per_batch or batch_rows + len(chunks[j]) > batch_size):
+            batches.append(np.concatenate(batch))
+            batch, batch_rows = [], 0
+        batch.append(chunks[j])
+        batch_rows += len(chunks[j])
+    if batch:
+        batches.append(np.concatenate(batch))
+    return batches
+
+
 def generate_protein_graph(prot_dict):
     new_edge_funcs = {"edge_construction_functions": [add_peptide_bonds,
                                                         # add_aromatic_interactions,
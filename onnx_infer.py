@@ -0,0 +1,290 @@
+"""
+Scores compound-protein pairs with a GGAP-CPI model exported by main.py --mode export_onnx, using only
+RDKit, NumPy and ONNX Runtime (no torch, chemprop or graphein).
+
+Usage: python onnx_infer.py --onnx_path {MODEL_PATH}/onnx --data_path {CSV with smiles and Uniprot_id columns}
+                             [--protein_store_path data/protein_store]
+
+The molecules are featurized as KANO_model.utils.MolGraph and BatchMolGraph do (without prompt). The proteins
+encoded at export time are read from proteins/<prot_id>.npz, the others are encoded from their graphs in the
+protein store written by process_data.py.
+"""
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import onnxruntime as ort
+from rdkit import Chem
+
+# the atom and bond features of chemprop, as used by KANO_model.utils.MolGraph
+ATOM_FEATURES = {
+    'atomic_num': list(range(100)),
+    'degree': [0, 1, 2, 3, 4, 5],
+    'formal_charge': [-1, -2, 1, 2, 0],
+    'chiral_tag': [0, 1, 2, 3],
+    'num_Hs': [0, 1, 2, 3, 4],
+    'hybridization': [int(Chem.rdchem.HybridizationType.SP),
+                      int(Chem.rdchem.HybridizationType.SP2),
+                      int(Chem.rdchem.HybridizationType.SP3),
+                      int(Chem.rdchem.HybridizationType.SP3D),
+                      int(Chem.rdchem.HybridizationType.SP3D2)],
+}
+ATOM_FDIM = sum(len(choices) + 1 for choices in ATOM_FEATURES.values()) + 2
+BOND_FDIM = 14
+BOND_TYPES = [Chem.rdchem.BondType.SINGLE, Chem.rdchem.BondType.DOUBLE,
+              Chem.rdchem.BondType.TRIPLE, Chem.rdchem.BondType.AROMATIC]
+# every molecule has a CLS row followed by up to 12 functional group rows
+FG_ROWS = 13
+
+
+def onek_encoding_unk(value, choices):
+    encoding = [0] * (len(choices) + 1)
+    encoding[choices.index(value) if value in choices else -1] = 1
+    return encoding
+
+
+def atom_features(atom):
+    return onek_encoding_unk(atom.GetAtomicNum() - 1, ATOM_FEATURES['atomic_num']) + \
+           onek_encoding_unk(atom.GetTotalDegree(), ATOM_FEATURES['degree']) + \
+           onek_encoding_unk(atom.GetFormalCharge(), ATOM_FEATURES['formal_charge']) + \
+           onek_encoding_unk(int(atom.GetChiralTag()), ATOM_FEATURES['chiral_tag']) + \
+           onek_encoding_unk(int(atom.GetTotalNumHs()), ATOM_FEATURES['num_Hs']) + \
+           onek_encoding_unk(int(atom.GetHybridization()), ATOM_FEATURES['hybridization']) + \
+           [1 if atom.GetIsAromatic() else 0] + [atom.GetMass() * 0.01]
+
+
+def bond_features(bond):
+    bt = bond.GetBondType()
+    return [0] + [bt == bond_type for bond_type in BOND_TYPES] + \
+           [bond.GetIsConjugated(), bond.IsInRing()] + onek_encoding_unk(int(bond.GetStereo()), list(range(6)))
+
+
+class MoleculeFeaturizer:
+    """Featurizes SMILES strings into the inputs of molecule.onnx."""
+
+    def __init__(self, onnx_path):
+        featurizer = np.load(os.path.join(onnx_path, 'featurizer.npz'))
+        self.fg_patterns = [Chem.MolFromSmarts(smarts) for smarts in featurizer['fg_smarts']]
+        self.fg_emb = featurizer['fg_emb']
+        self.graphs = {}
+
+    def featurize(self, smiles):
+        """
+        Computes the graph of a molecule.
+
+        :return: A dict of the atom, bond and functional group features, b2a and b2revb of the molecule.
+        """
+        if smiles in self.graphs:
+            return self.graphs[smiles]
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is None:
+            raise ValueError(f'invalid SMILES: {smiles}')
+        f_fgs = np.zeros((FG_ROWS, self.fg_emb.shape[1]), dtype=np.float32)
+        f_fgs[0] = 1
+        n_fgs = 1
+        for pattern, emb in zip(self.fg_patterns, self.fg_emb):
+            if mol.HasSubstructMatch(pattern):
+                f_fgs[n_fgs] = emb
+                n_fgs += 1
+                if n_fgs == FG_ROWS:
+                    break
+        # bond 2i = a1 --> a2 and bond 2i + 1 = a2 --> a1, in increasing (a1, a2) order
+        bonds = sorted((min(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()),
+                        max(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()), bond) for bond in mol.GetBonds())
+        pairs = np.array([(a1, a2) for a1, a2, _ in bonds], dtype=np.int64).reshape(-1)
+        graph = {'f_atoms': np.array([atom_features(atom) for atom in mol.GetAtoms()],
+                                     dtype=np.float32).reshape(-1, ATOM_FDIM),
+                 'f_bonds': np.array([bond_features(bond) for _, _, bond in bonds],
+                                     dtype=np.float32).reshape(-1, BOND_FDIM),
+                 'f_fgs': f_fgs, 'b2a': pairs, 'b2revb': np.arange(len(pairs)) ^ 1}
+        self.graphs[smiles] = graph
+        return graph
+
+    def batch(self, smiles_batch, mol_count=None):
+        """
+        Collates the graphs of a batch of molecules as BatchMolGraph and KANO_model.cmpn.encoder_inputs do.
+
+        :param mol_count: The number of rows of every molecule in the batch it was deduplicated from.
+        :return: A dict of the inputs of molecule.onnx.
+        """
+        graphs = [self.featurize(smiles) for smiles in smiles_batch]
+        atom_num = np.array([len(graph['f_atoms']) for graph in graphs], dtype=np.int64)
+        bond_num = np.array([len(graph['b2a']) for graph in graphs], dtype=np.int64)
+        # index 0 is zero padding
+        atom_start = 1 + np.cumsum(atom_num) - atom_num
+        bond_start = 1 + np.cumsum(bond_num) - bond_num
+        n_atoms, n_bonds = 1 + int(atom_num.sum()), 1 + int(bond_num.sum())
+
+        f_atoms = np.zeros((n_atoms, ATOM_FDIM), dtype=np.float32)
+        f_atoms[1:] = np.concatenate([graph['f_atoms'] for graph in graphs])
+        b2a = np.zeros(n_bonds, dtype=np.int64)
+        b2a[1:] = np.concatenate([graph['b2a'] for graph in graphs]) + np.repeat(atom_start, bond_num)
+        b2revb = np.zeros(n_bonds, dtype=np.int64)
+        b2revb[1:] = np.concatenate([graph['b2revb'] for graph in graphs]) + np.repeat(bond_start, bond_num)
+        # the features of a bond are those of its source atom followed by its own, shared by both directions
+        f_bonds = np.zeros((n_bonds, ATOM_FDIM + BOND_FDIM), dtype=np.float32)
+        f_bonds[1:, :ATOM_FDIM] = f_atoms[b2a[1:]]
+        f_bonds[1:, ATOM_FDIM:] = np.repeat(np.concatenate([graph['f_bonds'] for graph in graphs]), 2, axis=0)
+
+        # the incoming bonds of every atom in increasing bond order, padded with 0
+        b2dst = b2a[b2revb][1:]
+        in_bonds = np.bincount(b2dst, minlength=n_atoms)
+        order = np.argsort(b2dst, kind='stable')
+        position = np.arange(len(order)) - (np.cumsum(in_bonds) - in_bonds)[b2dst[order]]
+        a2b = np.zeros((n_atoms, max(1, int(in_bonds.max()))), dtype=np.int64)
+        a2b[b2dst[order], position] = order + 1
+
+        # the (molecule, position) of every atom in the padded layout, see KANO_model.cmpn.scope_index
+        mol_index = np.repeat(np.arange(len(graphs)), atom_num)
+        pos_index = np.arange(len(mol_index)) - (np.cumsum(atom_num) - atom_num)[mol_index]
+        atom_mask = np.zeros((len(graphs), int(atom_num.max())), dtype=bool)
+        atom_mask[mol_index, pos_index] = True
+        return {'f_atoms': f_atoms, 'f_bonds': f_bonds, 'a2b': a2b, 'b2a': b2a, 'b2revb': b2revb,
+                'f_fgs': np.concatenate([graph['f_fgs'] for graph in graphs]), 'atom_num': atom_num,
+                'cls_index': np.arange(len(graphs)) * FG_ROWS,
+                'target_index': np.repeat(np.arange(len(graphs)), FG_ROWS),
+                'mol_count': np.ones(len(graphs), dtype=np.float32) if mol_count is None
+                else np.asarray(mol_count, dtype=np.float32),
+                'atom_index': atom_start[mol_index] + pos_index, 'mol_index': mol_index,
+                'pos_index': pos_index, 'atom_mask': atom_mask}
+
+
+class ProteinStore:
+    """Reads the protein graphs of a utils.ProteinFeatureStore with NumPy."""
+
+    def __init__(self, path):
+        self.index = {}  # prot_id -> (shard index, protein index in shard)
+        self.shards = []  # list of (x, edge_index, offsets)
+        for shard in sorted(os.listdir(path)):
+            if shard.startswith('shard-'):
+                shard_dir = os.path.join(path, shard)
+                with open(os.path.join(shard_dir, 'keys.json'), 'r') as f:
+                    keys = json.load(f)
+                self.shards.append((np.load(os.path.join(shard_dir, 'x.npy'), mmap_mode='r'),
+                                    np.load(os.path.join(shard_dir, 'edge_index.npy'), mmap_mode='r'),
+                                    np.load(os.path.join(shard_dir, 'offsets.npy'))))
+                for i, key in enumerate(keys):
+                    self.index.setdefault(key, (len(self.shards) - 1, i))
+
+    def __contains__(self, prot_id):
+        return prot_id in self.index
+
+    def get(self, prot_id):
+        """
+        :return: The [residues, d] residue embeddings and the [2, num_edges] edges of a protein.
+        """
+        shard_idx, i = self.index[prot_id]
+        x, edge_index, offsets = self.shards[shard_idx]
+        (node_start, edge_start), (node_end, edge_end) = offsets[i], offsets[i + 1]
+        return (np.asarray(x[node_start:node_end], dtype=np.float32),
+                np.ascontiguousarray(edge_index[edge_start:edge_end].T, dtype=np.int64))
+
+
+class OnnxCPI:
+    """The molecule encoder, protein encoder and head of GGAP-CPI in ONNX Runtime."""
+
+    def __init__(self, onnx_path, num_threads=0, protein_store_path=None):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.sessions = {name: ort.InferenceSession(os.path.join(onnx_path, f'{name}.onnx'), options,
+                                                    providers=['CPUExecutionProvider'])
+                         for name in ['molecule', 'protein', 'keys', 'head']}
+        with open(os.path.join(onnx_path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.featurizer = MoleculeFeaturizer(onnx_path)
+        # the proteins encoded at export time, and the graphs of the others
+        self.protein_dir = os.path.join(onnx_path, 'proteins')
+        self.protein_store = ProteinStore(protein_store_path) if protein_store_path is not None else None
+        # encoded proteins by id
+        self.protein_cache = {}
+
+    def run(self, name, inputs):
+        session = self.sessions[name]
+        # the exporter drops the inputs a graph does not use
+        return session.run(None, {i.name: inputs[i.name] for i in session.get_inputs()})
+
+    def encode_protein(self, prot_id, x=None, edge_index=None):
+        """
+        Encodes a protein with protein.onnx, unless it was encoded at export time.
+
+        :param prot_id: The Uniprot_id of the protein.
+        :param x: The [residues, d] residue embeddings of the protein, if it is not in the protein store.
+        :param edge_index: The [2, num_edges] edges of the protein, along with x.
+        :return: The mean residue features and the [residues, 300] residue features.
+        """
+        if prot_id not in self.protein_cache:
+            path = os.path.join(self.protein_dir, f'{prot_id}.npz')
+            if x is None and os.path.exists(path):
+                with np.load(path) as protein:
+                    node_feat = protein['node_feat']
+            else:
+                if x is None:
+                    if self.protein_store is None or prot_id not in self.protein_store:
+                        raise KeyError(f'protein {prot_id} was not exported with the model '
+                                       f'and is not in the protein store')
+                    x, edge_index = self.protein_store.get(prot_id)
+                node_feat = self.run('protein', {'x': np.asarray(x, dtype=np.float32),
+                                                 'edge_index': np.asarray(edge_index, dtype=np.int64)})[0]
+            self.protein_cache[prot_id] = (node_feat.mean(axis=0), node_feat)
+        return self.protein_cache[prot_id]
+
+    def predict(self, smiles, prot_ids):
+        """
+        Predicts a batch of compound-protein pairs.
+
+        :param smiles: A list of SMILES strings.
+        :param prot_ids: The protein ids paired with smiles.
+        :return: A NumPy array of predictions.
+        """
+        # every distinct molecule and protein of the batch is encoded once
+        molecules, row_index = np.unique(smiles, return_inverse=True)
+        mol_feat, atom_feat, atom_mask = self.run('molecule', self.featurizer.batch(
+            molecules, np.bincount(row_index, minlength=len(molecules))))
+        proteins, prot_row_index = np.unique(prot_ids, return_inverse=True)
+        encoded = [self.encode_protein(prot_id) for prot_id in proteins]
+        max_m = max(len(node_feat) for _, node_feat in encoded)
+        prot_node_feat = np.zeros((len(proteins), max_m, encoded[0][1].shape[1]), dtype=np.float32)
+        prot_mask = np.zeros((len(proteins), max_m), dtype=bool)
+        for j, (_, node_feat) in enumerate(encoded):
+            prot_node_feat[j, :len(node_feat)] = node_feat
+            prot_mask[j, :len(node_feat)] = True
+        # the keys and values of the padded residues are those of a zero row, as in KANO_Prot
+        keys, values = self.run('keys', {'prot_node_feat': prot_node_feat})
+
+        output = self.run('head', {
+            'mol_feat': mol_feat[row_index], 'atom_feat': atom_feat[row_index], 'atom_mask': atom_mask[row_index],
+            'prot_graph_feat': np.stack([graph_feat for graph_feat, _ in encoded])[prot_row_index],
+            'keys': keys[prot_row_index], 'values': values[prot_row_index],
+            'prot_mask': prot_mask[prot_row_index]})[0].flatten()
+        if self.meta['dataset_type'] == 'classification':
+            output = 1 / (1 + np.exp(-output))
+        elif self.meta['scaler_means'] is not None:
+            output = output * np.array(self.meta['scaler_stds']) + np.array(self.meta['scaler_means'])
+        return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--onnx_path', type=str, required=True,
+                        help='Directory written by main.py --mode export_onnx')
+    parser.add_argument('--data_path', type=str, required=True,
+                        help='CSV file with smiles and Uniprot_id columns')
+    parser.add_argument('--save_path', type=str, default=None,
+                        help='CSV file to write the predictions to (default: <data_path>_onnx_pred.csv)')
+    parser.add_argument('--protein_store_path', type=str, default=None,
+                        help='Protein store of process_data.py with the graphs of the proteins '
+                             'that were not exported with the model')
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--num_threads', type=int, default=0,
+                        help='Number of threads of ONNX Runtime, 0 for its default')
+    args = parser.parse_args()
+
+    model = OnnxCPI(args.onnx_path, args.num_threads, args.protein_store_path)
+    df = pd.read_csv(args.data_path)
+    smiles, prot_ids = df['smiles'].values, df['Uniprot_id'].values
+    df['Prediction'] = np.concatenate([model.predict(smiles[i:i + args.batch_size], prot_ids[i:i + args.batch_size])
+                                       for i in range(0, len(df), args.batch_size)])
+    save_path = args.save_path or args.data_path.replace('.csv', '_onnx_pred.csv')
+    df.to_csv(save_path, index=False)
+    print(f'Prediction saved in {save_path}')
@@ -1,4 +1,4 @@
-import os, esm, torch, pickle, molvs, requests, argparse
+import os, pickle, molvs, requests, argparse
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
@@ -23,7 +23,8 @@ from graphein.protein.edges.distance import (add_peptide_bonds,
 from MoleculeACE.benchmark.cliffs import ActivityCliffs, get_tanimoto_matrix, \
                                         moleculeace_similarity, get_fc
 from data_prep import split_data
-from utils import set_seed, get_protein_sequence, check_molecule
+from utils import set_seed, get_protein_sequence, standardize_smiles, convert_protein_pickles, PROTEIN_FEAT_DIR
+from esm_extract import extract_embeddings, load_embedding, ESM_EMB_DIR
 
 def extract_sequence_from_pdb(pdb_file):
     parser = PDBParser(QUIET=True)
@@ -38,16 +39,15 @@ def extract_sequence_from_pdb(pdb_file):
             sequences.append(sequence)
     return sequences
 
-def generate_protein_graph(df):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()
-    model = model.to(device)
-    batch_converter = alphabet.get_batch_converter()
-    model.eval()
+def generate_protein_graph(df, esm_dir=ESM_EMB_DIR, tokens_per_batch=4096, num_workers=0):
     # path = 'refined-set'
     target = [i.split('.')[0] for i in df['Uniprot_id'].unique()]
     exist_pdb_file = [i.split('.')[0] for i in os.listdir('data/PDB')]
-    exist_file = os.listdir('data/Protein_pretrained_feat')
+    exist_file = os.listdir(PROTEIN_FEAT_DIR)
+    # ESM-2 embeddings of the new proteins, in batches and resumed if interrupted
+    extract_embeddings({pro: df[df['Uniprot_id'] == pro]['Sequence'].values[0]
+                        for pro in target if f'{pro}.pkl' not in exist_file},
+                       esm_dir, tokens_per_batch=tokens_per_batch, num_workers=num_workers)
     for pro in tqdm(target):
         # protein graph residue topology
         if f'{pro}.pkl' in exist_file:
@@ -76,14 +76,9 @@ def generate_protein_graph(df):
             g = convertor(g)
 
             # protein graph node feature
-            prot_data = [(pro, sequence)]
-            _, _, batch_tokens = batch_converter(prot_data)
-            batch_lens = (batch_tokens != alphabet.padding_idx).sum(1)
-            with torch.no_grad():
-                results = model(batch_tokens, repr_layers=[33], return_contacts=True)
-            esm_emb = results["representations"][33][0, 1: batch_lens-1].cpu().numpy()
+            esm_emb = load_embedding(pro, esm_dir)
 
-            with open(f'../Protein_pretrained_feat/{pro}.pkl', 'wb') as f:
+            with open(f'{PROTEIN_FEAT_DIR}/{pro}.pkl', 'wb') as f:
                 pickle.dump({pro: [sequence, esm_emb, g]}, f)
     return
 
@@ -102,6 +97,17 @@ if __name__ == '__main__':
                         help='Train ratio to split data into train/test sets')
     parser.add_argument('--seed', type=int, default=0,
                         help='Random seed')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(),
+                        help='Number of processes standardizing SMILES')
+    parser.add_argument('--protein_store_path', type=str, default='data/protein_store',
+                        help='Directory of the memory-mapped protein feature store to add the proteins to, '
+                             'None to only keep the pickles')
+    parser.add_argument('--esm_dir', type=str, default=ESM_EMB_DIR,
+                        help='Directory of the ESM-2 embeddings of the proteins, see esm_extract.py')
+    parser.add_argument('--esm_tokens_per_batch', type=int, default=4096,
+                        help='Maximum number of padded tokens per ESM-2 batch')
+    parser.add_argument('--esm_workers', type=int, default=0,
+                        help='Number of CPU processes computing ESM-2 embeddings, 0 to compute them in this process')
     args = parser.parse_args()
     args.dataset += '.csv'
 
@@ -122,7 +128,7 @@ if __name__ == '__main__':
         df['exp_mean [nM]'] = 0
 
     # check ligand structure
-    df['smiles'] = df['smiles'].apply(check_molecule)
+    df['smiles'] = standardize_smiles(df['smiles'], num_workers=args.num_workers)
     len_before = len(df)
     df = df.dropna(subset=['smiles'])
     print(f'{len_before - len(df)} invalid ligands are removed.')
@@ -138,7 +144,9 @@ if __name__ == '__main__':
                                             if '.pdb' in x else get_protein_sequence(x))
         
     # get protein graph
-    generate_protein_graph(df)
+    generate_protein_graph(df, args.esm_dir, args.esm_tokens_per_batch, args.esm_workers)
+    if args.protein_store_path != 'None':
+        convert_protein_pickles(args.protein_store_path, df['Uniprot_id'].unique())
 
     # data splitting
     df_all = []
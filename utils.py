@@ -1,8 +1,11 @@
 import os
+import uuid
 import random
 import json
+import shutil
 import logging
 import molvs
+import rdkit
 import requests
 import torch
 import pickle
@@ -12,10 +15,14 @@ from rdkit.Chem import AllChem
 from yaml import load, Loader
 from argparse import Namespace
 from warnings import simplefilter
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from chemprop.data import StandardScaler
+from torch_geometric.data import Data
 from chembl_webresource_client.new_client import new_client
 from MoleculeACE.benchmark.cliffs import ActivityCliffs
 from KANO_model.model import MoleculeModel, prompt_generator_output
+from KANO_model.graph_cache import LRUCache
 
 
 def define_logging(args, logger):
@@ -60,6 +67,10 @@ def set_up(args):
     args.device = torch.device(f'cuda:{args.gpu}' if torch.cuda.is_available() 
                     and not args.no_cuda else 'cpu')
     logger.info(f'device: {args.device}') if args.print else None
+    logger.info('--precision bf16 is experimental, check its RMSE against fp32 with benchmark.py precision') \
+        if args.print and args.precision == 'bf16' else None
+    logger.info('--batch_sampler protein is experimental, check its convergence against random with benchmark.py sampler') \
+        if args.print and args.batch_sampler == 'protein' else None
     
     return args, logger
 
@@ -81,7 +92,7 @@ def set_save_path(args):
         args.save_best_model_path = os.path.join(args.save_path, f'{args.train_model}_best_model_ft.pt')
         args.save_pred_path = os.path.join(args.save_path, f'{args.data_name}_test_pred_ft.csv')
         args.save_metric_path = os.path.join(args.save_path, f'{args.train_model}_metrics_ft.pkl')
-    elif args.mode in ['inference']:
+    elif args.mode in ['inference', 'compile', 'quantize', 'export_onnx']:
         args.save_path = args.model_path
         args.save_pred_path = os.path.join(args.save_path, f'{args.data_name}_test_pred_infer.csv')
         args.save_best_model_path = os.path.join(args.save_path, f'{args.train_model}_best_model.pt')
@@ -131,9 +142,20 @@ def set_seed(random_seed):
     torch.cuda.manual_seed_all(random_seed)
 
 
+STANDARDIZER = None  # molvs.Standardizer of this process, created on first use
+SMILES_CACHE_PATH = 'data/standardized_smiles.jsonl'
+# a map written by other versions of molvs or RDKit may standardize differently, it is not reused
+SMILES_CACHE_VERSION = f'molvs={molvs.__version__}|rdkit={rdkit.__version__}'
+SMILES_MAPS = {}  # raw -> standardized maps of this process by cache path, read once
+SMILES_EXECUTOR = None  # (num_workers, ProcessPoolExecutor) of standardize_smiles, kept across calls
+
+
 def check_molecule(smiles):
+    global STANDARDIZER
+    if STANDARDIZER is None:
+        STANDARDIZER = molvs.Standardizer()
     try:
-        mol = molvs.Standardizer().standardize(Chem.MolFromSmiles(smiles))
+        mol = STANDARDIZER.standardize(Chem.MolFromSmiles(smiles))
         if mol is None:
             return None
         else:
@@ -146,6 +168,79 @@ def check_molecule(smiles):
         print(f'Error: {smiles} is invalid')
         return None
 
+
+def load_smiles_map(cache_path):
+    """ Load the raw -> standardized map of cache_path, once per process.
+
+    The file is a JSON lines log: a header with SMILES_CACHE_VERSION, then one [raw, standardized]
+    pair per line. A file of another version is started over.
+
+    :param cache_path: JSON lines file of the map
+    :return: dict of standardized SMILES (None if invalid) by raw SMILES
+    """
+    if cache_path in SMILES_MAPS:
+        return SMILES_MAPS[cache_path]
+    smiles_map, version = {}, None
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of an interrupted run
+                    continue
+                if isinstance(entry, dict):
+                    version = entry.get('version')
+                elif version == SMILES_CACHE_VERSION:
+                    smiles_map[entry[0]] = entry[1]
+    if version != SMILES_CACHE_VERSION:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with open(cache_path, 'w') as f:
+            f.write(json.dumps({'version': SMILES_CACHE_VERSION}) + '\n')
+        smiles_map = {}
+    SMILES_MAPS[cache_path] = smiles_map
+    return smiles_map
+
+
+def standardize_smiles(smiles_list, num_workers: int = 0, cache_path: str = SMILES_CACHE_PATH):
+    """ Standardize SMILES in bulk with check_molecule.
+
+    Duplicates are standardized once, new SMILES are spread over num_workers processes (kept for
+    the next calls), and the raw -> standardized map is kept in memory and appended to cache_path
+    so that later runs and other datasets only standardize SMILES they have not seen before.
+
+    :param smiles_list: iterable of SMILES, entries that are not strings (e.g. NaN) give None
+    :param num_workers: number of worker processes, 0 standardizes in this process
+    :param cache_path: JSON lines file of the raw -> standardized map, None to not persist it
+    :return: list of standardized SMILES (None if invalid), aligned with smiles_list
+    """
+    global SMILES_EXECUTOR
+    smiles_list = list(smiles_list)
+    smiles_map = load_smiles_map(cache_path) if cache_path is not None else {}
+    new_smiles = [smi for smi in dict.fromkeys(smi for smi in smiles_list if isinstance(smi, str))
+                  if smi not in smiles_map]
+
+    if len(new_smiles) > 0:
+        if num_workers > 0:
+            if SMILES_EXECUTOR is None or SMILES_EXECUTOR[0] != num_workers:
+                if SMILES_EXECUTOR is not None:
+                    SMILES_EXECUTOR[1].shutdown()
+                SMILES_EXECUTOR = (num_workers, ProcessPoolExecutor(max_workers=num_workers))
+            std_smiles = list(SMILES_EXECUTOR[1].map(check_molecule, new_smiles,
+                                                     chunksize=max(1, len(new_smiles) // (num_workers * 16))))
+        else:
+            std_smiles = [check_molecule(smi) for smi in new_smiles]
+        smiles_map.update(zip(new_smiles, std_smiles))
+        if cache_path is not None:
+            # only the new pairs are appended, an interrupted write loses at most its last line
+            with open(cache_path, 'a+') as f:
+                f.seek(max(f.tell() - 1, 0))
+                if f.read(1) not in ['', '\n']:
+                    f.write('\n')
+                f.writelines(json.dumps([smi, std]) + '\n' for smi, std in zip(new_smiles, std_smiles))
+
+    return [smiles_map[smi] if isinstance(smi, str) else None for smi in smiles_list]
+
 def chembl_to_uniprot(chembl_id):
     target = new_client.target
     res = target.filter(target_chembl_id=chembl_id)
@@ -207,31 +302,225 @@ def get_molecule_feature(args, logger, smiles):
     return feat
 
 
-def get_protein_feature(args, logger, df_all):
-    logger.info('loading protein features...') if args.print else None
-    prot_list = df_all['Uniprot_id'].unique()
+PROTEIN_FEAT_DIR = 'data/Protein_pretrained_feat'
+
+
+def load_protein_pickle(prot_id, pickle_dir=PROTEIN_FEAT_DIR):
+    """
+    Loads the graph of a protein from its pickle, with its ESM-2 residue embeddings as node features.
+
+    :param prot_id: The Uniprot_id of the protein.
+    :param pickle_dir: The directory of the {prot_id}.pkl files written by process_data.py.
+    :return: The PyG graph of the protein.
+    """
+    with open(os.path.join(pickle_dir, f'{prot_id}.pkl'), 'rb') as f:
+        prot_feat = pickle.load(f)
+    prot_feat_values = list(prot_feat.values())[0]
+    feat, graph = prot_feat_values[1], prot_feat_values[-1]
+    x = torch.tensor(feat[:graph.num_nodes])
+    if x.shape[0] < graph.num_nodes:
+        x = torch.cat([x, torch.zeros(graph.num_nodes - x.shape[0], x.shape[1])], dim=0)
+    graph.x = x
+    return graph
+
+
+class ProteinFeatureStore:
+    """
+    A memory-mapped store of protein graphs (residue embeddings and edges), keyed by Uniprot_id.
+
+    Like the GraphStore of molecular graphs, the store is a directory of append-only shards. A shard holds
+    x.npy with the residue embeddings of all of its proteins back to back, edge_index.npy with their
+    [num_edges, 2] edges (node indices local to every protein), offsets.npy with the (node, edge) offsets
+    of every protein and keys.json with their ids. Opening the store only reads the offsets: the rows of
+    a protein are read from disk when its graph is used.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._index = {}  # prot_id -> (shard index, protein index in shard)
+        self._shards = []  # list of (x, edge_index, offsets)
+        if os.path.isdir(path):
+            for shard in sorted(os.listdir(path)):
+                if shard.startswith('shard-'):
+                    self._open_shard(os.path.join(path, shard))
+
+    def _open_shard(self, shard_dir: str):
+        with open(os.path.join(shard_dir, 'keys.json'), 'r') as f:
+            keys = json.load(f)
+        # copy-on-write, so that the graphs can share the mapped rows without copying them
+        x = np.load(os.path.join(shard_dir, 'x.npy'), mmap_mode='c')
+        edge_index = np.load(os.path.join(shard_dir, 'edge_index.npy'), mmap_mode='c')
+        offsets = np.load(os.path.join(shard_dir, 'offsets.npy'))
+        shard_idx = len(self._shards)
+        self._shards.append((x, edge_index, offsets))
+        for i, key in enumerate(keys):
+            self._index.setdefault(key, (shard_idx, i))
+
+    def __contains__(self, prot_id):
+        return prot_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, prot_id: str) -> Data:
+        """
+        Returns the graph of a protein, with node features backed by the memory-mapped store.
+
+        :param prot_id: The Uniprot_id of the protein.
+        :return: A PyG graph with x and edge_index.
+        """
+        shard_idx, i = self._index[prot_id]
+        x, edge_index, offsets = self._shards[shard_idx]
+        (node_start, edge_start), (node_end, edge_end) = offsets[i], offsets[i + 1]
+        return Data(x=torch.from_numpy(x[node_start:node_end]),
+                    edge_index=torch.from_numpy(np.ascontiguousarray(edge_index[edge_start:edge_end].T,
+                                                                     dtype=np.int64)),
+                    num_nodes=int(node_end - node_start))
+
+    def add(self, graphs):
+        """
+        Writes the graphs of new proteins to a new shard.
+
+        The residue embeddings are streamed to disk one protein at a time, so that the graphs
+        do not have to fit in memory together.
+
+        :param graphs: An iterable of (prot_id, x, edge_index) of NumPy arrays, with x of shape
+                       [num_nodes, d] and edge_index of shape [2, num_edges].
+        """
+        shard_name = f'shard-{uuid.uuid4().hex}'
+        # write to a temporary directory first so that readers never see half-written shards
+        tmp_dir = os.path.join(self.path, f'.tmp-{shard_name}')
+        os.makedirs(tmp_dir)
+        keys, edges, offsets, dim = [], [], [(0, 0)], None
+        with open(os.path.join(tmp_dir, 'x.raw'), 'wb') as f:
+            for prot_id, x, edge_index in graphs:
+                if prot_id in self._index or prot_id in keys:
+                    continue
+                x = np.ascontiguousarray(x, dtype=np.float32)
+                dim = x.shape[1]
+                f.write(x.tobytes())
+                edges.append(np.asarray(edge_index, dtype=np.int32).T)
+                keys.append(prot_id)
+                offsets.append((offsets[-1][0] + len(x), offsets[-1][1] + edges[-1].shape[0]))
+        if not keys:
+            shutil.rmtree(tmp_dir)
+            return
+
+        raw = np.memmap(os.path.join(tmp_dir, 'x.raw'), dtype=np.float32, mode='r', shape=(offsets[-1][0], dim))
+        x = np.lib.format.open_memmap(os.path.join(tmp_dir, 'x.npy'), mode='w+', dtype=np.float32, shape=raw.shape)
+        for start in range(0, len(raw), 1 << 16):
+            x[start:start + (1 << 16)] = raw[start:start + (1 << 16)]
+        x.flush()
+        del raw, x
+        os.remove(os.path.join(tmp_dir, 'x.raw'))
+        np.save(os.path.join(tmp_dir, 'edge_index.npy'), np.concatenate(edges, axis=0))
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(tmp_dir, 'keys.json'), 'w') as f:
+            json.dump(keys, f)
+        shard_dir = os.path.join(self.path, shard_name)
+        os.rename(tmp_dir, shard_dir)
+        self._open_shard(shard_dir)
+
+
+def convert_protein_pickles(store_path: str, prot_ids=None, pickle_dir: str = PROTEIN_FEAT_DIR):
+    """
+    Adds the protein pickles written by process_data.py to a ProteinFeatureStore.
+
+    :param store_path: The directory of the store.
+    :param prot_ids: The Uniprot_ids to add, by default those of all pickles in pickle_dir.
+    :return: The store.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    store = ProteinFeatureStore(store_path)
+    if prot_ids is None:
+        prot_ids = sorted(file[:-len('.pkl')] for file in os.listdir(pickle_dir) if file.endswith('.pkl'))
+    missing = [prot_id for prot_id in prot_ids if prot_id not in store]
+
+    def graphs():
+        for prot_id in missing:
+            graph = load_protein_pickle(prot_id, pickle_dir)
+            yield prot_id, graph.x.numpy(), graph.edge_index.numpy()
+    store.add(graphs())
+    return store
+
+
+def graph_nbytes(graph: Data) -> int:
+    return sum(value.element_size() * value.nelement() for _, value in graph if torch.is_tensor(value))
+
+
+class ProteinGraphCache(Mapping):
+    """
+    A read-only mapping from Uniprot_id to protein graph that loads every graph on first access.
+
+    Loaded graphs are kept in an LRU cache bounded by the bytes of their tensors, so that the proteins
+    of large datasets do not have to fit in memory together. The LRU counts hits, misses and evictions.
+    """
+
+    def __init__(self, prot_ids, load, max_bytes=None):
+        """
+        :param prot_ids: The Uniprot_ids of the mapping.
+        :param load: A function loading the graph of a Uniprot_id.
+        :param max_bytes: The memory budget of the cached graphs, None for no limit.
+        """
+        self.prot_ids = list(prot_ids)
+        self._keys = set(self.prot_ids)
+        self.load = load
+        self.cache = LRUCache(float('inf') if max_bytes is None else max_bytes, sizeof=graph_nbytes)
+
+    def __getitem__(self, prot_id):
+        if prot_id not in self._keys:
+            raise KeyError(prot_id)
+        graph = self.cache.get(prot_id)
+        if graph is None:
+            graph = self.load(prot_id)
+            self.cache.put(prot_id, graph)
+        return graph
 
-    prot_graph_dict = {}
-    for prot_id in prot_list:
-        with open(f'data/Protein_pretrained_feat/{prot_id}.pkl', 'rb') as f:
-            prot_feat = pickle.load(f)
-        prot_feat_values = list(prot_feat.values())[0]
-        feat, graph = prot_feat_values[1], prot_feat_values[-1]
+    def __contains__(self, prot_id):
+        # without loading the graph
+        return prot_id in self._keys
 
+    def __iter__(self):
+        return iter(self.prot_ids)
+
+    def __len__(self):
+        return len(self.prot_ids)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+def get_protein_feature(args, logger, df_all):
+    """
+    Maps the proteins of a dataset to their graphs, loaded on first access from the ProteinFeatureStore
+    of args.protein_store_path or from their pickles and cached within args.protein_cache_mb.
+
+    :return: A ProteinGraphCache.
+    """
+    prot_list = df_all['Uniprot_id'].unique()
+    # the ESM ablation needs the residue names of the graphein graphs, which only the pickles keep
+    store = None
+    if args.protein_store_path is not None and args.ablation != 'ESM':
+        store = ProteinFeatureStore(args.protein_store_path)
+
+    def load(prot_id):
+        if store is not None and prot_id in store:
+            return store.get(prot_id)
         try:
-            # x = torch.tensor(feat[:graph.num_nodes], device=args.device)
-            x = torch.tensor(feat[:graph.num_nodes])
-            if x.shape[0] < graph.num_nodes:
-                # x = torch.cat([x, torch.zeros(graph.num_nodes - x.shape[0], x.shape[1], device=args.device)], dim=0)
-                x = torch.cat([x, torch.zeros(graph.num_nodes - x.shape[0], x.shape[1])], dim=0)
-            graph.x = x
+            graph = load_protein_pickle(prot_id)
         except Exception as e:
             logger.error(f'Error processing {prot_id}: {e}')
-            continue
-
-        prot_graph_dict[prot_id] = graph
-
-    return prot_graph_dict
+            raise
+        if args.ablation == 'ESM':
+            return graph
+        # the same attributes as the graphs of the store, so that batches do not depend on where a graph is from
+        return Data(x=graph.x, edge_index=graph.edge_index, num_nodes=graph.num_nodes)
+
+    n_stored = 0 if store is None else sum(prot_id in store for prot_id in prot_list)
+    logger.info(f'{len(prot_list)} proteins, {n_stored} in {args.protein_store_path} and the others in pickles, '
+                f'loaded on first use') if args.print else None
+    max_bytes = None if args.protein_cache_mb is None else int(args.protein_cache_mb * 2 ** 20)
+    return ProteinGraphCache(prot_list, load, max_bytes)
 
 
 def set_collect_metric(args):